@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Headless batch renderer for the Label Guides extension.
+
+Renders a list of preset templates (or all of them) and/or a directory of
+input SVGs to an output directory, without starting Inkscape. Each job runs
+the extension's effect() in a worker process from a multiprocessing pool.
+
+Any options not recognised here are passed straight through to the
+extension, for example:
+
+    ./batch_render.py -o out all --draw_inset_shapes=false
+
+Licenced under the GNU General Public License v2.0
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+
+import label_guides
+from label_geometry import SHAPE_TABS
+
+# Blank A4 document used when there is no input SVG to render onto
+BLANK_SVG = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<svg xmlns="http://www.w3.org/2000/svg"
+   xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
+   xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+   width="210mm" height="297mm" viewBox="0 0 210 297" version="1.1">
+  <sodipodi:namedview id="namedview1" inkscape:document-units="mm"/>
+</svg>
+"""
+
+
+def preset_args(preset_id):
+    """
+    Get the extension arguments that select the given preset
+    """
+
+    try:
+        preset = label_guides.PRESETS[preset_id]
+    except KeyError:
+        raise ValueError("Unknown preset: {}".format(preset_id))
+
+    tab = SHAPE_TABS[preset.shapes]
+
+    return ['--preset_tab=' + tab,
+            '--{}_preset={}'.format(tab, preset_id)]
+
+
+def render_job(job):
+    """
+    Run the extension for a single job, in a worker process.
+
+    Returns (output path, error string or None)
+    """
+
+    in_file, out_file, args = job
+
+    try:
+        label_guides.LabelGuides().run(
+                args + ['--output=' + out_file, in_file])
+    except (Exception, SystemExit) as e:
+        return (out_file, "{}: {}".format(type(e).__name__, e))
+
+    return (out_file, None)
+
+
+def build_jobs(presets, svg_files, blank_file, out_dir, extra_args):
+    """
+    Build the list of (input, output, args) jobs for the requested
+    combination of presets and input files
+    """
+
+    jobs = []
+
+    # No presets means "use whatever the passed-through options say"
+    preset_list = presets if presets else [None]
+    inputs = svg_files if svg_files else [blank_file]
+
+    for in_file in inputs:
+
+        stem = None
+        if in_file != blank_file:
+            stem = os.path.splitext(os.path.basename(in_file))[0]
+
+        for preset_id in preset_list:
+
+            args = list(extra_args)
+            name_parts = []
+
+            if stem:
+                name_parts.append(stem)
+
+            if preset_id is not None:
+                args = preset_args(preset_id) + args
+                name_parts.append(preset_id)
+
+            if not name_parts:
+                name_parts.append("custom")
+
+            out_file = os.path.join(out_dir, "_".join(name_parts) + ".svg")
+            jobs.append((in_file, out_file, args))
+
+    return jobs
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+            description='Render label templates to SVG without Inkscape. '
+                        'Unrecognised options are passed to the extension.')
+    parser.add_argument('presets', nargs='*',
+                        help='preset IDs to render, or "all"')
+    parser.add_argument('-i', '--input-dir',
+                        help='render onto every SVG in this directory')
+    parser.add_argument('-o', '--output-dir', required=True,
+                        help='directory to write the results to')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='verbose mode')
+
+    args, extra_args = parser.parse_known_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(message)s")
+
+    presets = args.presets
+    if 'all' in presets:
+        presets = list(label_guides.PRESETS.keys())
+
+    svg_files = []
+    if args.input_dir:
+        svg_files = sorted(
+                os.path.join(args.input_dir, f)
+                for f in os.listdir(args.input_dir)
+                if f.lower().endswith('.svg'))
+
+    if not presets and not svg_files:
+        parser.error("nothing to render: give preset IDs or --input-dir")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        blank_file = os.path.join(tmp_dir, "blank.svg")
+        with open(blank_file, 'w') as f:
+            f.write(BLANK_SVG)
+
+        try:
+            jobs = build_jobs(presets, svg_files, blank_file,
+                              args.output_dir, extra_args)
+        except ValueError as e:
+            parser.error(str(e))
+
+        failed = 0
+
+        with multiprocessing.Pool(args.jobs) as pool:
+            for out_file, err in pool.imap_unordered(render_job, jobs):
+
+                if err:
+                    failed += 1
+                    logging.error("Failed to render %s: %s", out_file, err)
+                else:
+                    logging.debug("Rendered %s", out_file)
+
+    logging.info("Rendered %d of %d templates", len(jobs) - failed, len(jobs))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the Label Guides extension.
+
+Runs LabelGuides.effect() headlessly on a blank document for every preset
+and for synthetic custom grids, across combinations of the drawing options,
+and records for each case:
+
+    * wall time (best of --repeat runs)
+    * peak Python memory (tracemalloc, lowest of --repeat runs)
+    * number of guides and SVG elements in the result
+    * size of the serialised output, not counting element IDs
+
+Results can be saved as a baseline and later runs compared against it:
+
+    ./benchmark.py --save-baseline bench_baseline.json
+    ./benchmark.py --baseline bench_baseline.json
+
+It also checks that label_geometry imports within a time budget, and
+without pulling in inkex or lxml.
+
+Licenced under the GNU General Public License v2.0
+"""
+
+import argparse
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import inkex
+
+import label_guides
+from batch_render import BLANK_SVG, preset_args
+
+# The drawing options that are switched on and off between cases
+DRAW_FLAGS = [
+        'draw_edge_guides',
+        'draw_centre_guides',
+        'draw_inset_guides',
+        'draw_shapes',
+        'draw_inset_shapes',
+]
+
+# Custom grid sizes to run by default (N means an N x N grid)
+DEFAULT_GRIDS = [10, 50, 100, 500]
+
+# Growth in peak memory that is never flagged, however small the baseline,
+# in bytes
+DEFAULT_MEMORY_FLOOR = 64 * 1024
+
+# IDs, and references to them. inkex makes IDs up at random, so they are
+# left out of the output size
+ID_VALUE = re.compile(rb'(\bid="|="#|url\(#)[^")]*')
+
+# Default budget for importing label_geometry, in ms
+DEFAULT_IMPORT_BUDGET = 25
+
+# Modules that label_geometry must not import
+HEAVY_MODULES = ['inkex', 'lxml']
+
+# Times importing a module in a fresh interpreter
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [m for m in {heavy!r} if m in sys.modules]]))
+"""
+
+
+def flag_combinations(all_combos):
+    """
+    Get the sets of drawing flags to run: every combination, or just
+    "everything on" and each stage on its own
+    """
+
+    if all_combos:
+        return [dict(zip(DRAW_FLAGS, c))
+                for c in itertools.product([True, False],
+                                           repeat=len(DRAW_FLAGS))]
+
+    combos = [dict.fromkeys(DRAW_FLAGS, True)]
+
+    for flag in DRAW_FLAGS:
+        combo = dict.fromkeys(DRAW_FLAGS, False)
+        combo[flag] = True
+        combos.append(combo)
+
+    return combos
+
+
+def combo_name(combo):
+    """
+    Short name for a set of flags, e.g. "edge+shapes"
+    """
+
+    on = [f.replace('draw_', '').replace('_guides', '')
+          for f in DRAW_FLAGS if combo[f]]
+
+    return "+".join(on) if on else "none"
+
+
+def grid_args(n):
+    """
+    Extension arguments for a custom N x N grid of 1mm labels
+    """
+
+    return ['--preset_tab=custom', '--units=mm',
+            '--margin_l=1', '--margin_t=1',
+            '--size_x=1', '--size_y=1',
+            '--pitch_x=1.2', '--pitch_y=1.2',
+            '--count_x={}'.format(n), '--count_y={}'.format(n),
+            '--shapes=rect',
+            '--inset=0.1', '--shape_inset=0.1']
+
+
+def build_cases(presets, grids, all_combos):
+    """
+    Get the list of (case name, extension arguments) to run
+    """
+
+    templates = [(p, preset_args(p)) for p in presets]
+    templates += [("grid{0}x{0}".format(n), grid_args(n)) for n in grids]
+
+    cases = []
+
+    for name, args in templates:
+        for combo in flag_combinations(all_combos):
+
+            flag_args = ['--{}={}'.format(f, str(v).lower())
+                         for f, v in combo.items()]
+
+            cases.append(("{}/{}".format(name, combo_name(combo)),
+                          args + flag_args))
+
+    return cases
+
+
+def run_once(args, blank_file):
+    """
+    Run the extension once, returning the extension and the output bytes
+    """
+
+    out = io.BytesIO()
+
+    ext = label_guides.LabelGuides()
+    ext.run(args + [blank_file], output=out)
+
+    return ext, out.getvalue()
+
+
+def measure(args, blank_file, repeat):
+    """
+    Measure one benchmark case
+    """
+
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ext, output = run_once(args, blank_file)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    # Separate runs for memory, as tracing slows everything down
+    peak = None
+
+    for _ in range(repeat):
+        tracemalloc.start()
+        try:
+            run_once(args, blank_file)
+            _, run_peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        peak = run_peak if peak is None else min(peak, run_peak)
+
+    root = ext.document.getroot()
+
+    return {
+            'time': best,
+            'peak_mem': peak,
+            'guides': len(root.findall(
+                './/' + inkex.addNS('guide', 'sodipodi'))),
+            'elements': sum(1 for _ in root.iter()),
+            'bytes': len(ID_VALUE.sub(rb'\1', output)),
+    }
+
+
+def measure_import(module, repeat):
+    """
+    Measure the time to import a module in a fresh interpreter, returning
+    the best time and the heavy modules it imported
+    """
+
+    best = None
+    heavy = []
+
+    for _ in range(repeat):
+        out = subprocess.run(
+                [sys.executable, '-c',
+                 IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                check=True, stdout=subprocess.PIPE).stdout
+
+        elapsed, heavy = json.loads(out)
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, heavy
+
+
+def check_import(budget_ms, repeat):
+    """
+    Check that label_geometry imports within budget and without inkex,
+    returning a list of problem messages
+    """
+
+    elapsed, heavy = measure_import('label_geometry', repeat)
+
+    logging.info("%-40s %9.2fms", "import/label_geometry", elapsed * 1000)
+
+    problems = []
+
+    if elapsed * 1000 > budget_ms:
+        problems.append("import/label_geometry: {:.2f}ms > {:g}ms".format(
+                elapsed * 1000, budget_ms))
+
+    if heavy:
+        problems.append("import/label_geometry: imports " +
+                        ", ".join(heavy))
+
+    return problems
+
+
+def compare(results, baseline, time_tolerance,
+            memory_floor=DEFAULT_MEMORY_FLOOR):
+    """
+    Compare results to a baseline, returning a list of regression messages.
+
+    Times (and peak memory) may grow by the given fraction before they are
+    flagged, and peak memory also by at least memory_floor bytes. Any
+    change in the counts or output size is flagged, as that means the
+    output itself changed.
+    """
+
+    problems = []
+
+    for name, res in results.items():
+
+        base = baseline.get(name)
+
+        if base is None:
+            continue
+
+        for key, floor in [('time', 0), ('peak_mem', memory_floor)]:
+            if res[key] > base[key] * (1 + time_tolerance) and \
+                    res[key] - base[key] > floor:
+                problems.append("{}: {} {:.4g} -> {:.4g} (+{:.0%})".format(
+                        name, key, base[key], res[key],
+                        res[key] / base[key] - 1))
+
+        for key in ['guides', 'elements', 'bytes']:
+            if res[key] != base[key]:
+                problems.append("{}: {} changed {} -> {}".format(
+                        name, key, base[key], res[key]))
+
+    return problems
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+            description='Benchmark the Label Guides extension')
+    parser.add_argument('presets', nargs='*',
+                        help='preset IDs to run (default: all)')
+    parser.add_argument('--grids', default=",".join(map(str, DEFAULT_GRIDS)),
+                        help='comma separated custom N x N grid sizes '
+                             '(empty for none)')
+    parser.add_argument('--no-presets', action='store_true',
+                        help='only run the custom grids')
+    parser.add_argument('--all-combos', action='store_true',
+                        help='run every combination of the drawing options, '
+                             'rather than all-on and each stage alone')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs per case, the best time is kept')
+    parser.add_argument('--baseline',
+                        help='compare against this baseline file')
+    parser.add_argument('--save-baseline',
+                        help='save the results to this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed fractional slowdown before a case '
+                             'counts as a regression')
+    parser.add_argument('--memory-floor', type=float,
+                        default=DEFAULT_MEMORY_FLOOR / 1024,
+                        help='growth in peak memory (kB) that never counts '
+                             'as a regression (default: %(default)g)')
+    parser.add_argument('--import-budget', type=float,
+                        default=DEFAULT_IMPORT_BUDGET,
+                        help='most time (ms) importing label_geometry may '
+                             'take')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='verbose mode')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(message)s")
+
+    presets = []
+    if not args.no_presets:
+        presets = args.presets or list(label_guides.PRESETS.keys())
+
+    grids = [int(g) for g in args.grids.split(',') if g.strip()]
+
+    cases = build_cases(presets, grids, args.all_combos)
+
+    import_problems = check_import(args.import_budget, args.repeat)
+
+    for p in import_problems:
+        logging.error("REGRESSION %s", p)
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        blank_file = os.path.join(tmp_dir, "blank.svg")
+        with open(blank_file, 'w') as f:
+            f.write(BLANK_SVG)
+
+        for name, ext_args in cases:
+            res = measure(ext_args, blank_file, args.repeat)
+            results[name] = res
+
+            logging.info("%-40s %9.2fms %8.1fkB %6d guides %7d elements "
+                         "%9d bytes", name, res['time'] * 1000,
+                         res['peak_mem'] / 1024, res['guides'],
+                         res['elements'], res['bytes'])
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        problems = compare(results, baseline, args.tolerance,
+                           args.memory_floor * 1024)
+
+        for p in problems:
+            logging.error("REGRESSION %s", p)
+
+        if problems:
+            return 1
+
+        logging.info("No regressions against %s", args.baseline)
+
+    return 1 if import_problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,19 +4,233 @@
 Simple download tool for scraping LabelPlanet.co.uk pages for label
 template specifications. Can output the descriptions for use in an INX file
 enum, as well as the definitions for use in the label_guides.py enxtension's
-database.
+preset catalog (label_guides_presets.csv).
 
 Licenced under the GNU General Public License v2.0
 """
 
 from lxml.html import fromstring
 import requests
-import requests_cache
 import re
 
 import logging
 from pprint import pformat
 import argparse
+import concurrent.futures
+import copy
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+# URLs of the template list pages, by label type
+LIST_PAGES = {
+        'rrect': 'rectangular-rounded-corners',
+        'rect': 'rectangular-square-corners',
+        'circ': 'round',
+        'oval': 'oval',
+        'square': 'square'
+}
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls to wait() so that there are at most `rate` per second,
+    across all threads. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SpecCache(object):
+    """
+    Cache of parsed pages, keyed by URL, along with the ETag and
+    Last-Modified headers needed to revalidate them.
+
+    The cache file is a journal of JSON lines, one per page, where later
+    lines replace earlier ones. Every page fetched (or revalidated) in a run
+    is appended straight away with a "done" mark, which checkpoints the run:
+    if it's interrupted, the next run picks up the pages that were done
+    without asking the server again. finish() compacts the file and clears
+    the marks once a run completes.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.done = set()
+
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # probably a line cut short by an interruption
+                        logging.warning("Skipping bad cache line in %s",
+                                        path)
+                        continue
+
+                    if not isinstance(entry, dict) or 'url' not in entry:
+                        logging.warning("Skipping cache line with no URL "
+                                        "in %s", path)
+                        continue
+
+                    url = entry.pop('url')
+                    self.pages[url] = entry
+
+                    if entry.pop('done', False):
+                        self.done.add(url)
+                    else:
+                        self.done.discard(url)
+
+    def get(self, url):
+        return self.pages.get(url)
+
+    def is_done(self, url):
+        return url in self.done
+
+    def put(self, url, etag, last_modified, data):
+        """
+        Store a parsed page, and checkpoint it as done in this run
+        """
+
+        entry = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'data': data
+        }
+
+        with self.lock:
+            self.pages[url] = entry
+            self.done.add(url)
+
+            line = dict(entry, url=url, done=True)
+
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(line) + "\n")
+
+    def finish(self):
+        """
+        Mark the run as complete: rewrite the cache with one line per page
+        and no checkpoint marks
+        """
+
+        with self.lock:
+            tmp = self.path + ".tmp"
+
+            with open(tmp, 'w', encoding='utf-8') as f:
+                for url, entry in self.pages.items():
+                    f.write(json.dumps(dict(entry, url=url)) + "\n")
+
+            os.replace(tmp, self.path)
+            self.done = set()
+
+
+class Fetcher(object):
+    """
+    Fetches pages over a single pooled session, shared between threads,
+    under a rate limit, and optionally through a SpecCache
+    """
+
+    def __init__(self, concurrency=8, rate=0, timeout=30, cache=None):
+
+        self.session = requests.Session()
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate)
+        self.cache = cache
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency,
+                                                pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url):
+
+        self.limiter.wait()
+
+        r = self.session.get(url, timeout=self.timeout)
+        r.raise_for_status()
+
+        return r.text
+
+    def get_parsed(self, url, parse):
+        """
+        Get a page and parse it with parse(text), which must return
+        something JSON-serialisable.
+
+        With a cache, pages already done in an interrupted run are used as
+        they are, and other cached pages are revalidated with a conditional
+        request, so they're only downloaded and parsed again if they changed.
+        """
+
+        if self.cache is None:
+            return parse(self.get(url))
+
+        entry = self.cache.get(url)
+
+        if entry is not None and self.cache.is_done(url):
+            logging.debug("Resuming with cached %s", url)
+            return copy.deepcopy(entry['data'])
+
+        headers = {}
+
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        self.limiter.wait()
+
+        r = self.session.get(url, headers=headers, timeout=self.timeout)
+
+        if r.status_code == 304:
+            if entry is None:
+                raise requests.HTTPError(
+                        "Not modified, but nothing cached for " + url,
+                        response=r)
+
+            logging.debug("Not modified: %s", url)
+            data = entry['data']
+
+            # a 304 needn't repeat the validators, so keep the ones we had
+            etag = r.headers.get('ETag', entry['etag'])
+            last_modified = r.headers.get('Last-Modified',
+                                          entry['last_modified'])
+        else:
+            r.raise_for_status()
+            data = parse(r.text)
+
+            etag = r.headers.get('ETag')
+            last_modified = r.headers.get('Last-Modified')
+
+        self.cache.put(url, etag, last_modified, data)
+
+        return copy.deepcopy(data)
 
 
 class FormatFinder(object):
@@ -24,6 +238,12 @@ class FormatFinder(object):
     Gets a list of known formats from a template list page
     """
 
+    # Base URL of the template list pages
+    base_url = "https://www.labelplanet.co.uk/label-templates/"
+
+    def __init__(self, fetcher=None):
+        self.fetcher = fetcher if fetcher else Fetcher()
+
     def _nth_cell_text(self, row, nth):
 
         selector = "td:nth-child({})".format(nth)
@@ -77,8 +297,7 @@ class FormatFinder(object):
 
     def get_list(self, list_page):
 
-        url = ("https://www.labelplanet.co.uk/label-templates/" +
-               list_page + ".php")
+        url = self.base_url + list_page + ".php"
 
         shape = {
                 "rectangular-rounded-corners": "rrect",
@@ -88,9 +307,16 @@ class FormatFinder(object):
                 "oval": "circle"
                 }[list_page]
 
-        r = requests.get(url)
+        items = self.fetcher.get_parsed(url, self._parse_list)
+
+        for item in items:
+            item['shape'] = shape
+
+        return items
+
+    def _parse_list(self, text):
 
-        doc = fromstring(r.text)
+        doc = fromstring(text)
 
         items = []
 
@@ -101,7 +327,6 @@ class FormatFinder(object):
                 item = self._get_item_from_row(prod_row)
 
                 if (item):
-                    item['shape'] = shape
                     items.append(item)
 
         return items
@@ -114,8 +339,11 @@ class SpecRipper(object):
     Updates the given item with description and label spec
     """
 
-    def __init__(self, item):
+    def __init__(self, item, fetcher=None):
         self.item = item
+        # only make a fetcher when one's needed, so offline parsing
+        # doesn't open any sessions
+        self.fetcher = fetcher
 
     def _get_desc_text(self, doc):
 
@@ -132,17 +360,38 @@ class SpecRipper(object):
 
         return None
 
-    def _get_cell_by_xy(self, table, x, y):
+    def _walk_table(self, table):
+        """
+        Walk the rows of a table once, returning a list of the <td> cells
+        of each row, so that cells can then be looked up by position without
+        any further searching.
+
+        Only elements count, so comments between rows don't shift them. Some
+        pages are missing the <tr> of a row, leaving its cells loose in the
+        table: a run of loose cells is taken as one row, as a browser would.
+        """
 
-        nxt = table.xpath(".//tr[2]/following-sibling::*[1]")[0]
+        first_row = next(table.iter('tr'))
 
-        # handle broken table formatting
-        # (missing <tr> on third row)
-        if nxt.tag == "td" and y > 3:
-            y += 3
+        rows = []
+        loose = None
 
-        selector = "tr:nth-child({y}) > td:nth-child({x})".format(x=x, y=y)
-        return table.cssselect(selector)[0]
+        for child in first_row.getparent().iterchildren('*'):
+
+            if child.tag == 'tr':
+                rows.append([td for td in child.iterchildren('td')])
+                loose = None
+            elif child.tag == 'td':
+                if loose is None:
+                    loose = []
+                    rows.append(loose)
+                loose.append(child)
+
+        return rows
+
+    def _get_cell_by_xy(self, rows, x, y):
+
+        return rows[y - 1][x - 1]
 
     def _get_dim_from_text(self, txt):
 
@@ -151,6 +400,7 @@ class SpecRipper(object):
     def _get_xy_template_spec(self, doc):
 
         table = doc.cssselect('.templatetable')[0]
+        rows = self._walk_table(table)
 
         # cell x, cell y, data
         data_cells = [
@@ -168,7 +418,7 @@ class SpecRipper(object):
 
         for c in data_cells:
 
-            txt = self._get_cell_by_xy(table, c[0], c[1]).text_content()
+            txt = self._get_cell_by_xy(rows, c[0], c[1]).text_content()
 
             if c[3] == 'dim':
                 txt = self._get_dim_from_text(txt)
@@ -183,17 +433,23 @@ class SpecRipper(object):
 
         url = self.item['prodlink']
 
-        r = requests.get(url)
+        if not self.fetcher:
+            self.fetcher = Fetcher()
 
-        doc = fromstring(r.text)
+        page = self.fetcher.get_parsed(url, self._parse_page)
 
-        self.item['desc'] = self._get_desc_text(doc)
+        logging.debug(pformat(page['layout']))
 
-        spec = self._get_xy_template_spec(doc)
+        self.item.update(page)
 
-        logging.debug(pformat(spec))
+    def _parse_page(self, text):
 
-        self.item['layout'] = spec
+        doc = fromstring(text)
+
+        return {
+                'desc': self._get_desc_text(doc),
+                'layout': self._get_xy_template_spec(doc)
+        }
 
 
 class InxFormatter(object):
@@ -239,9 +495,8 @@ class SpecFormatter(object):
 
         layout = item['layout']
 
-        s = "{indent}{idcode:16}['reg', 'mm', '{sheet}', {ml}, {mt}, {sx}, {sy}, {px}, {py}, {nx}, {ny}, '{shape}'],".format(
-                indent=" " * 4,
-                idcode="'{}':".format(idcode),
+        s = "{idcode},reg,mm,{sheet},{ml},{mt},{sx},{sy},{px},{py},{nx},{ny},{shape}".format(
+                idcode=idcode,
                 sheet=sheet,
                 ml=layout['margin_l'],
                 mt=layout['margin_t'],
@@ -257,6 +512,107 @@ class SpecFormatter(object):
         return s
 
 
+def scrape_all(label_types, fetcher, concurrency, on_item):
+    """
+    Scrape the lists for the given label types, and then every product
+    page on them, with up to `concurrency` requests in flight.
+
+    on_item(item, error) is called as each product finishes (in whatever
+    order they finish), with error set if that one failed. Returns the
+    number of failures.
+    """
+
+    failures = 0
+    finder = FormatFinder(fetcher)
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+
+        lists = {pool.submit(finder.get_list, LIST_PAGES[t]): t
+                 for t in label_types}
+
+        scrapes = {}
+
+        for fut in concurrent.futures.as_completed(lists):
+
+            try:
+                items = fut.result()
+            except Exception as e:
+                logging.error("Failed to get list for %s: %s",
+                              lists[fut], e)
+                failures += 1
+                continue
+
+            logging.debug("Got list of specs for %s: ", lists[fut])
+            logging.debug(pformat(items))
+
+            for item in items:
+                ripper = SpecRipper(item, fetcher)
+                scrapes[pool.submit(ripper.scrape)] = item
+
+        for fut in concurrent.futures.as_completed(scrapes):
+
+            item = scrapes[fut]
+
+            try:
+                fut.result()
+            except Exception as e:
+                failures += 1
+                on_item(item, e)
+            else:
+                on_item(item, None)
+
+    return failures
+
+
+def parse_saved_page(path):
+    """
+    Parse a saved template page, in a worker process.
+
+    Returns a record with the file, description and layout, or the error
+    """
+
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            page = SpecRipper(None)._parse_page(f.read())
+    except Exception as e:
+        return {'file': path, 'error': "{}: {}".format(type(e).__name__, e)}
+
+    page['file'] = path
+    return page
+
+
+def parse_offline(page_dir, jobs, out):
+    """
+    Parse every saved HTML page in a directory, in a process pool, writing
+    one JSON record per page to out as they finish.
+
+    Returns the number of pages that failed
+    """
+
+    files = sorted(os.path.join(page_dir, f) for f in os.listdir(page_dir)
+                   if f.lower().endswith(('.html', '.htm')))
+
+    failures = 0
+
+    with multiprocessing.Pool(jobs) as pool:
+
+        # pages are small, so hand them out in batches
+        chunksize = max(1, len(files) // (4 * (jobs or os.cpu_count() or 1)))
+
+        for rec in pool.imap_unordered(parse_saved_page, files, chunksize):
+
+            if 'error' in rec:
+                failures += 1
+                logging.error("Failed to parse %s: %s", rec['file'],
+                              rec['error'])
+
+            out.write(json.dumps(rec, sort_keys=True) + "\n")
+
+    logging.info("Parsed %d of %d pages", len(files) - failures, len(files))
+
+    return failures
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(
@@ -264,57 +620,106 @@ if __name__ == "__main__":
                         'LabelPlanet.co.uk')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='verbose mode')
-    parser.add_argument('-t', '--type', action='store', required=True,
-                        choices=['rrect', 'rect', 'circ', 'oval', 'square'],
-                        help='label type')
+    parser.add_argument('-t', '--type', action='store',
+                        nargs='+', choices=sorted(LIST_PAGES) + ['all'],
+                        help='label type(s)')
     parser.add_argument('--inx', action='store_true',
                         help='print INX items')
     parser.add_argument('--spec', action='store_true',
                         help='print specification items')
+    parser.add_argument('--inx-file',
+                        help='write INX items to this file, not stdout')
+    parser.add_argument('--spec-file',
+                        help='write specification items to this file, '
+                             'not stdout')
+    parser.add_argument('-j', '--concurrency', type=int, default=8,
+                        help='maximum number of requests at once')
+    parser.add_argument('--rate', type=float, default=5,
+                        help='maximum requests per second (0 for no limit)')
+    parser.add_argument('--base-url', default=FormatFinder.base_url,
+                        help='base URL of the template list pages')
+    parser.add_argument('--cache', default='spec_cache.jsonl',
+                        help='page cache file (empty for no cache)')
+    parser.add_argument('--restart', action='store_true',
+                        help="don't resume an interrupted run, revalidate "
+                             "every page")
+    parser.add_argument('--offline', metavar='DIR',
+                        help='parse the saved template pages in DIR instead '
+                             'of downloading, printing JSON records')
+    parser.add_argument('--offline-jobs', type=int, default=None,
+                        help='number of parser processes for --offline '
+                             '(default: CPU count)')
 
     args = parser.parse_args()
 
-    # avoid re-downloading pages
-    requests_cache.install_cache('demo_cache')
-
-    # convert type
-    label_type = {
-            'rrect': 'rectangular-rounded-corners',
-            'rect': 'rectangular-square-corners',
-            'circ': 'round',
-            'oval': 'oval',
-            'square': 'square'
-    }[args.type]
-
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
 
-    ff = FormatFinder()
-    spec_list = ff.get_list(label_type)
+    if args.offline:
+        failures = parse_offline(args.offline, args.offline_jobs, sys.stdout)
+        sys.exit(1 if failures else 0)
+
+    if not args.type:
+        parser.error("give the label type(s) with -t, or use --offline")
+
+    FormatFinder.base_url = args.base_url
+
+    label_types = args.type
+    if 'all' in label_types:
+        label_types = sorted(LIST_PAGES)
+
+    inx_out = open(args.inx_file, 'w') if args.inx_file else sys.stdout
+    spec_out = open(args.spec_file, 'w') if args.spec_file else sys.stdout
+
+    inx_f = InxFormatter()
+    spec_f = SpecFormatter()
+
+    # Output each item as soon as it's done, so a failure part-way through
+    # doesn't lose everything before it
+    def output_item(item, error):
 
-    logging.debug("Got list of specs: ")
-    logging.debug(pformat(spec_list))
+        if error:
+            logging.error("Failed to scrape %s (%s): %s", item['lpcode'],
+                          item['prodlink'], error)
+            return
 
-    # get spec layouts + descs etc
-    for spec in spec_list:
+        try:
+            inx = inx_f.format_inx(item) if args.inx else None
+            spec = spec_f.format_spec(item) if args.spec else None
+        except Exception as e:
+            logging.error("Failed to format %s: %s", item['lpcode'], e)
+            return
 
-        spec_ripper = SpecRipper(spec)
+        if inx:
+            inx_out.write(inx + "\n")
+            inx_out.flush()
 
-        spec_ripper.scrape()
+        if spec:
+            spec_out.write(spec + "\n")
+            spec_out.flush()
 
-    if args.inx:
-        inx_f = InxFormatter()
+    # avoid re-downloading pages, and resume interrupted runs
+    cache = None
 
-        for s in spec_list:
+    if args.cache:
+        cache = SpecCache(args.cache)
 
-            inx = inx_f.format_inx(s)
-            print(inx)
+        if args.restart:
+            cache.finish()
+        elif cache.done:
+            logging.info("Resuming: %d page(s) already done",
+                         len(cache.done))
 
-    if args.spec:
+    fetcher = Fetcher(concurrency=args.concurrency, rate=args.rate,
+                      cache=cache)
 
-        spec_f = SpecFormatter()
+    failures = scrape_all(label_types, fetcher, args.concurrency,
+                          output_item)
 
-        for s in spec_list:
+    if failures:
+        # keep the checkpoint, so a re-run only retries what failed
+        logging.error("%d item(s) failed", failures)
+        sys.exit(1)
 
-            spec = spec_f.format_spec(s)
-            print(spec)
+    if cache:
+        cache.finish()
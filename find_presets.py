@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Find Label Guides presets from the measurements of a sheet.
+
+Searches the preset catalog (including any extra catalogs listed in
+LABEL_GUIDES_PRESETS) by label size, and optionally pitch, number of labels,
+page size and shape, within a tolerance:
+
+    ./find_presets.py 63.5x38.1 --count 21 --tolerance 0.3
+    ./find_presets.py 2.5x1.5 --units in --nearest 3
+
+With --nearest, the closest presets are listed however far off they are.
+
+Licenced under the GNU General Public License v2.0
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+import label_geometry
+from label_geometry import UNIT_MM
+
+
+def parse_pair(text, scale):
+    """
+    Parse an "XxY" pair of lengths into mm, given the mm in one unit
+    """
+
+    size = None
+
+    if text not in label_geometry.PAGE_SIZES:
+        size = label_geometry.parse_page_size(text)
+
+    if size is None:
+        raise argparse.ArgumentTypeError("not a size: {}".format(text))
+
+    return (size[0] * scale, size[1] * scale)
+
+
+def format_match(diff, dims):
+
+    page = ("{:g}x{:g}".format(dims.page_x, dims.page_y)
+            if dims.page_x is not None else '?')
+
+    return "{:<12} {:>7g} x {:<7g} pitch {:>6g} x {:<6g} {:>3} x {:<3} " \
+        "= {:<4} {:>9} {:<6} {:.2f}".format(
+            dims.id, dims.size_x, dims.size_y, dims.pitch_x, dims.pitch_y,
+            dims.count_x, dims.count_y, dims.count, page, dims.shapes, diff)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+            description='Find Label Guides presets by label size and sheet '
+                        'layout')
+    parser.add_argument('size',
+                        help='label size, as WxH (e.g. 63.5x38.1)')
+    parser.add_argument('--units', default='mm', choices=sorted(UNIT_MM),
+                        help='units of the lengths given (default: mm); '
+                             'results are always in mm')
+    parser.add_argument('--pitch',
+                        help='label pitch, as XxY')
+    parser.add_argument('--count', type=int,
+                        help='number of labels per sheet')
+    parser.add_argument('--across', type=int,
+                        help='number of labels across')
+    parser.add_argument('--down', type=int,
+                        help='number of labels down')
+    parser.add_argument('--page',
+                        help='page size, as WxH or a named size (a4)')
+    parser.add_argument('--shape', action='append',
+                        choices=['rrect', 'rect', 'circle'],
+                        help='label shape (can be given more than once)')
+    parser.add_argument('--layout', choices=sorted(label_geometry.LAYOUTS),
+                        help='label layout')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.5,
+                        help='largest difference in any length, in the '
+                             'units given (default: 0.5)')
+    parser.add_argument('-n', '--nearest', type=int, metavar='N',
+                        help='list the N closest presets, ignoring the '
+                             'tolerance')
+    parser.add_argument('--json', action='store_true',
+                        help='write the matches as JSON')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='verbose mode')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(message)s")
+
+    scale = UNIT_MM[args.units]
+
+    try:
+        size = parse_pair(args.size, scale)
+        pitch = parse_pair(args.pitch, scale) if args.pitch else (None, None)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    page = None
+
+    if args.page in label_geometry.PAGE_SIZES:
+        page = label_geometry.PAGE_SIZES[args.page]
+    elif args.page:
+        try:
+            page = parse_pair(args.page, scale)
+        except argparse.ArgumentTypeError as e:
+            parser.error(str(e))
+
+    criteria = {
+            'pitch_x': pitch[0],
+            'pitch_y': pitch[1],
+            'page': page,
+            'count': args.count,
+            'count_x': args.across,
+            'count_y': args.down,
+            'shapes': args.shape,
+            'layout': args.layout,
+    }
+
+    index = label_geometry.DIMENSIONS
+
+    # build the index first, so the search itself can be timed
+    indexed = len(index)
+
+    start = time.perf_counter()
+
+    if args.nearest:
+        matches = index.nearest(size[0], size[1], limit=args.nearest,
+                                **criteria)
+    else:
+        matches = index.find(size[0], size[1],
+                             tolerance=args.tolerance * scale, **criteria)
+
+    logging.debug("Searched %d presets in %.3fms", indexed,
+                  (time.perf_counter() - start) * 1000)
+
+    if args.json:
+        json.dump([dict(dims._asdict(), difference=diff)
+                   for diff, dims in matches], sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        for diff, dims in matches:
+            print(format_match(diff, dims))
+
+    if not matches:
+        logging.info("No matching presets")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1027 @@
+#!/usr/bin/env python3
+'''
+Label Guides geometry
+
+The preset catalog and the layout maths of the Label Guides extension, with
+no dependency on inkex or an SVG document, so other tools can work out label
+cell positions cheaply:
+
+    import label_geometry
+
+    opts = label_geometry.preset_opts('L7160', label_geometry.mm_scale)
+    cells = label_geometry.LabelGrid(opts).cells()
+
+Lengths are in "user units": whatever the scale function given converts
+the template units to (by default, the template units themselves).
+
+NumPy is used for the cell arrays when it is available, but it's only
+imported on first use, to keep importing this module cheap.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; version 2 of the License.
+'''
+
+import bisect
+import heapq
+import math
+import os
+from array import array
+from collections import namedtuple
+from collections.abc import Mapping
+
+# Length of one of each unit, in mm
+UNIT_MM = {
+        'mm': 1.0,
+        'cm': 10.0,
+        'in': 25.4,
+        'pt': 25.4 / 72,
+        'px': 25.4 / 96,
+}
+
+_NOT_LOADED = object()
+_numpy_module = _NOT_LOADED
+
+
+def _numpy():
+    """
+    Get the numpy module, or None if it isn't installed
+    """
+
+    global _numpy_module
+
+    if _numpy_module is _NOT_LOADED:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        _numpy_module = numpy
+
+    return _numpy_module
+
+
+def mm_scale(unit):
+    """
+    Scale function for working in mm
+    """
+
+    return UNIT_MM[unit]
+
+
+# Preset catalog files. The bundled catalog is always loaded, and further
+# catalogs (e.g. from other vendors) can be listed in the environment
+# variable below, separated by os.pathsep
+PRESET_FILES = [
+        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     'label_guides_presets.csv'),
+]
+PRESET_PATH_ENV = 'LABEL_GUIDES_PRESETS'
+
+# A single preset record.
+# Regular grids are defined as:
+#       'reg', unit, page_size, l marg, t marg, X size, Y size,
+#       X pitch, Y pitch, Number across, Number down, shapes
+# Other layouts (see LAYOUTS) use the same fields, followed by any
+# parameters of the layout
+Preset = namedtuple('Preset', [
+        'layout', 'units', 'page_size',
+        'margin_l', 'margin_t', 'size_x', 'size_y',
+        'pitch_x', 'pitch_y', 'count_x', 'count_y', 'shapes',
+        'params'], defaults=[()])
+
+
+class PresetIndex(Mapping):
+    """
+    Read-only mapping of preset ID to Preset record, backed by one or more
+    catalog files.
+
+    Nothing is read until the first lookup. The files are then scanned once
+    to index the raw record lines by ID, and each record is only parsed into
+    a Preset when it is first asked for, so a large catalog costs little
+    more than the lines that are actually used.
+    """
+
+    def __init__(self, files, env_var=None):
+        self._files = list(files)
+        self._env_var = env_var
+        self._lines = None
+        self._records = {}
+
+    def _catalog_files(self):
+
+        files = list(self._files)
+
+        if self._env_var and os.environ.get(self._env_var):
+            files.extend(f for f in
+                         os.environ[self._env_var].split(os.pathsep) if f)
+
+        return files
+
+    def _load(self):
+
+        if self._lines is not None:
+            return self._lines
+
+        lines = {}
+
+        # Later files override earlier ones with the same ID
+        for fn in self._catalog_files():
+            with open(fn, encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+
+                    if not line or line.startswith('#'):
+                        continue
+
+                    preset_id, _, rest = line.partition(',')
+                    lines[preset_id.strip()] = rest
+
+        self._lines = lines
+        return lines
+
+    def _parse(self, rest):
+
+        fields = [f.strip() for f in rest.split(',')]
+
+        if len(fields) < len(Preset._fields) - 1:
+            raise ValueError("Bad preset record: " + rest)
+
+        return Preset(
+                fields[0], fields[1], fields[2],
+                *[float(f) for f in fields[3:9]],
+                int(fields[9]), int(fields[10]), fields[11],
+                tuple(fields[12:]))
+
+    def __getitem__(self, preset_id):
+
+        try:
+            return self._records[preset_id]
+        except KeyError:
+            pass
+
+        record = self._parse(self._load()[preset_id])
+        self._records[preset_id] = record
+        return record
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __contains__(self, preset_id):
+        return preset_id in self._load()
+
+
+PRESETS = PresetIndex(PRESET_FILES, PRESET_PATH_ENV)
+
+# Which notebook tab of the extension handles each preset shape
+SHAPE_TABS = {
+        'rrect': 'rrect',
+        'rect': 'rect',
+        'circle': 'circ',
+}
+
+# Named page sizes, in the template unit
+PAGE_SIZES = {
+        'a4': [210, 297],
+}
+
+
+def parse_page_size(size):
+    """
+    Get a page size from a definition entry - can be in the form
+    [x, y], a string "XxY", or a named size (one of PAGE_SIZES)
+
+    Returns None if the size can't be worked out
+    """
+
+    if isinstance(size, (list,)):
+        # Explicit size
+        return size
+    elif size in PAGE_SIZES:
+        return PAGE_SIZES[size]
+
+    try:
+        x, y = size.lower().split('x')
+        return [float(x), float(y)]
+    except (AttributeError, ValueError):
+        pass
+
+    return None
+
+
+def _linear_positions(start, pitch, count):
+    """
+    Positions start + i * pitch for i in [0, count), as an array.
+
+    Each position is computed directly from its index, so there is no
+    accumulated error from repeatedly adding the pitch.
+    """
+
+    numpy = _numpy()
+    if numpy is not None:
+        return start + pitch * numpy.arange(count, dtype=float)
+
+    return array('d', [start + i * pitch for i in range(count)])
+
+
+def _interleave(a, b):
+    """
+    Interleave two equal-length arrays: [a0, b0, a1, b1, ...]
+    """
+
+    numpy = _numpy()
+    if numpy is not None:
+        return numpy.column_stack((a, b)).ravel()
+
+    out = array('d', bytes(16 * len(a)))
+    out[0::2] = a
+    out[1::2] = b
+    return out
+
+
+def _shifted(positions, offset):
+    """
+    Get a copy of an array of positions, all moved by the given offset
+    """
+
+    numpy = _numpy()
+    if numpy is not None:
+        return positions + offset
+
+    return array('d', [p + offset for p in positions])
+
+
+def _as_array(values):
+    """
+    Get a sequence of numbers as an array
+    """
+
+    numpy = _numpy()
+    if numpy is not None:
+        return numpy.asarray(values, dtype=float)
+
+    return array('d', values)
+
+
+def _concat(*arrays):
+    """
+    Join arrays end to end
+    """
+
+    numpy = _numpy()
+    if numpy is not None:
+        return numpy.concatenate(arrays)
+
+    out = array('d')
+    for a in arrays:
+        out.extend(a)
+    return out
+
+
+def _distinct(positions):
+    """
+    Get the distinct values in an array of positions, in order
+    """
+
+    numpy = _numpy()
+    if numpy is not None:
+        return numpy.unique(positions)
+
+    return array('d', sorted(set(positions)))
+
+
+def _grid_cells(xs, ys):
+    """
+    Get the cells of a grid of columns xs and rows ys, as (x, y) arrays,
+    column by column
+    """
+
+    numpy = _numpy()
+    if numpy is not None:
+        return numpy.repeat(xs, len(ys)), numpy.tile(ys, len(xs))
+
+    return (array('d', [x for x in xs for _ in ys]),
+            array('d', [y for _ in xs for y in ys]))
+
+
+def _regular_layout(label_opts):
+    """
+    A regular grid: count_x by count_y labels, at the given pitches
+    """
+
+    xs = _linear_positions(label_opts['margin']['l'],
+                           label_opts['pitch']['x'],
+                           label_opts['count']['x'])
+    ys = _linear_positions(label_opts['margin']['t'],
+                           label_opts['pitch']['y'],
+                           label_opts['count']['y'])
+
+    return _grid_cells(xs, ys) + (xs, ys)
+
+
+def _staggered_layout(label_opts):
+    """
+    Rows of labels at the given pitches, with every other row (the second,
+    fourth, etc.) moved right by the layout's offset and holding
+    alt_count labels
+    """
+
+    layout = label_opts['layout']
+    count_y = label_opts['count']['y']
+    pitch_x = label_opts['pitch']['x']
+    pitch_y = label_opts['pitch']['y']
+
+    if layout['type'] == 'hex' and not pitch_y:
+        # close-packed: each label touches the two in the row above
+        pitch_y = pitch_x * math.sqrt(3) / 2
+
+    # the plain and offset rows are two regular grids, interleaved
+    pitch = {'x': pitch_x, 'y': 2 * pitch_y}
+
+    plain = dict(label_opts, pitch=pitch,
+                 count={'x': label_opts['count']['x'],
+                        'y': (count_y + 1) // 2})
+    offset = dict(label_opts, pitch=pitch,
+                  margin={'l': label_opts['margin']['l'] + layout['offset'],
+                          't': label_opts['margin']['t'] + pitch_y},
+                  count={'x': layout['alt_count'], 'y': count_y // 2})
+
+    px, py, pxs, pys = _regular_layout(plain)
+    ox, oy, oxs, oys = _regular_layout(offset)
+
+    return (_concat(px, ox), _concat(py, oy),
+            _distinct(_concat(pxs, oxs)), _distinct(_concat(pys, oys)))
+
+
+def _list_layout(label_opts):
+    """
+    An explicit list of label positions, relative to the margins
+    """
+
+    cells = label_opts['layout']['cells']
+
+    x = _as_array([label_opts['margin']['l'] + c[0] for c in cells])
+    y = _as_array([label_opts['margin']['t'] + c[1] for c in cells])
+
+    return x, y, _distinct(x), _distinct(y)
+
+
+# Label layouts, by name. Each gets the top-left corners of all the cells
+# of a template as a pair of (x, y) arrays, followed by the distinct column
+# and row positions
+LAYOUTS = {
+        'reg': _regular_layout,
+        'stag': _staggered_layout,
+        'hex': _staggered_layout,
+        'list': _list_layout,
+}
+
+
+def layout_params(layout, params, pitch_x, count_x, to_uu):
+    """
+    Work out the 'layout' entry of a set of label options, from the layout
+    name and its parameters (strings, in template units), converting
+    lengths with to_uu
+
+    * 'reg': no parameters
+    * 'stag': [offset of alternate rows, labels in alternate rows],
+      defaulting to half the X pitch and one fewer label
+    * 'hex': [labels in alternate rows], with the alternate rows offset by
+      half the X pitch
+    * 'list': x, y pairs of label positions relative to the margins
+    """
+
+    # blank parameters take their defaults
+    params = [p if p != '' else None for p in params]
+
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout: {}".format(layout))
+
+    opts = {'type': layout}
+
+    if layout in ('stag', 'hex'):
+
+        if layout == 'hex':
+            params = [None] + params
+
+        offset = params[0] if len(params) > 0 else None
+        alt_count = params[1] if len(params) > 1 else None
+
+        opts['offset'] = (to_uu(float(offset)) if offset is not None
+                          else pitch_x / 2)
+        opts['alt_count'] = (int(alt_count) if alt_count is not None
+                             else max(count_x - 1, 0))
+
+    elif layout == 'list':
+
+        if len(params) % 2 or None in params:
+            raise ValueError("Bad coordinates in label list")
+
+        lengths = [to_uu(float(p)) for p in params]
+        opts['cells'] = list(zip(lengths[0::2], lengths[1::2]))
+
+    return opts
+
+
+class LabelGrid(object):
+    """
+    The cell geometry of a label template, in user units.
+
+    The layout is compiled once into arrays (NumPy when available) of the
+    top-left corners of every cell, and the distinct column and row edges.
+    Each drawing stage derives its positions from those, so the cost of a
+    stage is linear in the number of labels, whatever the layout.
+    """
+
+    def __init__(self, label_opts):
+
+        self.size_x = label_opts['size']['x']
+        self.size_y = label_opts['size']['y']
+
+        layout = label_opts.get('layout', {'type': 'reg'})['type']
+
+        # Top-left corner of every cell, column by column, and the left
+        # and top edges of each column and row of cells
+        self.x, self.y, self.left, self.top = LAYOUTS[layout](label_opts)
+
+    def edges(self, inset):
+        """
+        Get the cell edges, moved inwards by inset, as a dict of
+        interleaved near/far edge positions for the vertical ('v') and
+        horizontal ('h') directions.
+        """
+
+        return {
+                'v': _interleave(
+                    _shifted(self.left, inset),
+                    _shifted(self.left, self.size_x - inset)),
+                'h': _interleave(
+                    _shifted(self.top, inset),
+                    _shifted(self.top, self.size_y - inset)),
+        }
+
+    def centres(self):
+        """
+        Get the column ('x') and row ('y') centre positions
+        """
+
+        return {
+                'x': _shifted(self.left, self.size_x / 2),
+                'y': _shifted(self.top, self.size_y / 2),
+        }
+
+    def cells(self, offset_x=0, offset_y=0):
+        """
+        Get the (x, y) top-left corner of every cell, column by column,
+        moved by the given offsets
+        """
+
+        return list(zip(_shifted(self.x, offset_x).tolist(),
+                        _shifted(self.y, offset_y).tolist()))
+
+    def rows(self):
+        """
+        Get the (x, y) top-left corner of every cell, left to right and
+        then top to bottom
+        """
+
+        return sorted(self.cells(), key=lambda c: (c[1], c[0]))
+
+
+def _scaled(values, scale):
+    """
+    Get a list of lengths multiplied by a scale, converted in one go
+    """
+
+    numpy = _numpy()
+    if numpy is not None:
+        return (numpy.asarray(values, dtype=float) * scale).tolist()
+
+    return [v * scale for v in values]
+
+
+def preset_opts(preset_id, uu_scale=None, corner_rad=None):
+    """
+    Get the label options for a preset template.
+
+    uu_scale gives the number of user units in one of a unit (by default,
+    1 for everything, so lengths stay in the template units), and
+    corner_rad is the corner radius in template units, if any.
+    """
+
+    return record_opts(PRESETS[preset_id], uu_scale, corner_rad)
+
+
+def record_opts(preset, uu_scale=None, corner_rad=None):
+    """
+    Get the label options for a preset record, as for preset_opts()
+    """
+
+    unit = preset.units
+    scale = uu_scale(unit) if uu_scale else 1.0
+
+    # margins, sizes and pitches, all converted in one go
+    ml, mt, sx, sy, px, py = _scaled(
+            [preset.margin_l, preset.margin_t,
+             preset.size_x, preset.size_y,
+             preset.pitch_x, preset.pitch_y], scale)
+
+    return {
+            'units': unit,
+            'page_size': parse_page_size(preset.page_size),
+            'margin': {
+                'l': ml,
+                't': mt
+             },
+            'size': {
+                'x': sx,
+                'y': sy
+            },
+            'pitch': {
+                'x': px,
+                'y': py
+            },
+            'count': {
+                'x': preset.count_x,
+                'y': preset.count_y
+            },
+            'shapes': preset.shapes,
+            'corner_rad': (float(corner_rad) * scale
+                           if corner_rad is not None else None),
+            'layout': layout_params(
+                preset.layout, preset.params, px, preset.count_x,
+                lambda v: v * scale),
+    }
+
+
+def custom_opts(units, margin_l, margin_t, size_x, size_y, pitch_x, pitch_y,
+                count_x, count_y, shapes, layout='reg', stagger_offset=0,
+                stagger_count=0, uu_scale=None):
+    """
+    Get the label options for a custom template, given in the given units.
+    Zero stagger options take the layout's defaults.
+    """
+
+    scale = uu_scale(units) if uu_scale else 1.0
+
+    opts = {
+            'units': units,
+            'page_size': None,
+            'margin': {
+                'l': float(margin_l) * scale,
+                't': float(margin_t) * scale
+            },
+            'size': {
+                'x': float(size_x) * scale,
+                'y': float(size_y) * scale
+            },
+            'pitch': {
+                'x': float(pitch_x) * scale,
+                'y': float(pitch_y) * scale
+            },
+            'count': {
+                'x': count_x,
+                'y': count_y
+            },
+            'shapes': shapes,
+            'corner_rad': None,
+    }
+
+    params = [str(stagger_offset or ''), str(stagger_count or '')]
+
+    if layout == 'hex':
+        params = params[1:]
+
+    opts['layout'] = layout_params(layout, params, opts['pitch']['x'],
+                                   count_x, lambda v: v * scale)
+
+    return opts
+
+
+def regular_guides(label_opts, inset):
+    """
+    Get the guide positions at the (inset) edges of the columns and rows of
+    labels, for any layout, as lists of vertical ('v') and horizontal ('h')
+    positions
+    """
+
+    guides = LabelGrid(label_opts).edges(inset)
+
+    return {
+            'v': guides['v'].tolist(),
+            'h': guides['h'].tolist()
+    }
+
+
+# Dimensions of a preset, in mm (count is the number of labels per sheet,
+# and the page size is None if it isn't known)
+PresetDims = namedtuple('PresetDims', [
+        'id', 'shapes', 'layout', 'size_x', 'size_y', 'pitch_x', 'pitch_y',
+        'count_x', 'count_y', 'count', 'page_x', 'page_y'])
+
+
+class DimensionIndex(object):
+    """
+    Index of the presets in a catalog by their dimensions, in mm, for
+    finding templates from the measurements of a sheet.
+
+    The presets are kept sorted by label width, so a search only looks at
+    those in a narrow band of widths (bisected out of the sorted list) and
+    checks the other dimensions for them alone. The index is built on first
+    use, from the catalog as it is then.
+
+    Searches can be narrowed with these criteria:
+
+    * pitch_x, pitch_y: label pitches, in mm
+    * page: the page size, (x, y) in mm
+    * count, count_x, count_y: labels per sheet, across and down
+    * shapes: a collection of shapes to accept
+    * layout: the layout name
+
+    Lengths count towards the difference between a preset and the search,
+    which is the largest difference of any length compared, in mm. Counts,
+    shapes and layouts must match exactly.
+    """
+
+    CRITERIA = ['pitch_x', 'pitch_y', 'page', 'count', 'count_x', 'count_y',
+                'shapes', 'layout']
+
+    def __init__(self, presets):
+        self._presets = presets
+        self._dims = None
+        self._keys = None
+
+    def _preset_dims(self, preset_id):
+
+        preset = self._presets[preset_id]
+        scale = UNIT_MM[preset.units]
+
+        if preset.layout == 'reg':
+            count = preset.count_x * preset.count_y
+        else:
+            count = len(LabelGrid(record_opts(preset)).x)
+
+        page = parse_page_size(preset.page_size) or [None, None]
+
+        # named page sizes are in mm already
+        if preset.page_size not in PAGE_SIZES and page[0] is not None:
+            page = [page[0] * scale, page[1] * scale]
+
+        return PresetDims(
+                preset_id, preset.shapes, preset.layout,
+                preset.size_x * scale, preset.size_y * scale,
+                preset.pitch_x * scale, preset.pitch_y * scale,
+                preset.count_x, preset.count_y, count, page[0], page[1])
+
+    def _load(self):
+
+        if self._dims is not None:
+            return self._dims
+
+        dims = [self._preset_dims(preset_id) for preset_id in self._presets]
+        dims.sort(key=lambda d: d.size_x)
+
+        self._dims = dims
+        self._keys = [d.size_x for d in dims]
+        return dims
+
+    def __len__(self):
+        return len(self._load())
+
+    def _matcher(self, size_x, size_y, criteria):
+        """
+        Get a function giving the difference between a preset and a search,
+        or None if the preset doesn't meet the exact criteria
+        """
+
+        unknown = set(criteria) - set(self.CRITERIA)
+        if unknown:
+            raise TypeError("Unknown search criteria: " +
+                            ", ".join(sorted(unknown)))
+
+        exact = [(name, criteria[name])
+                 for name in ('count', 'count_x', 'count_y', 'layout')
+                 if criteria.get(name) is not None]
+
+        shapes = criteria.get('shapes')
+
+        lengths = [(n, criteria[n]) for n in ('pitch_x', 'pitch_y')
+                   if criteria.get(n) is not None]
+
+        page = criteria.get('page')
+        if page is not None:
+            lengths.extend([('page_x', page[0]), ('page_y', page[1])])
+
+        def difference(dims):
+
+            for name, want in exact:
+                if getattr(dims, name) != want:
+                    return None
+
+            if shapes is not None and dims.shapes not in shapes:
+                return None
+
+            if page is not None and dims.page_x is None:
+                return None
+
+            diff = max(abs(dims.size_x - size_x), abs(dims.size_y - size_y))
+
+            for name, want in lengths:
+                diff = max(diff, abs(getattr(dims, name) - want))
+
+            return diff
+
+        return difference
+
+    def find(self, size_x, size_y, tolerance=0.5, **criteria):
+        """
+        Find the presets with labels size_x by size_y mm, give or take
+        tolerance mm, that meet the criteria.
+
+        Returns a list of (difference, PresetDims), closest first
+        """
+
+        dims = self._load()
+        difference = self._matcher(size_x, size_y, criteria)
+
+        lo = bisect.bisect_left(self._keys, size_x - tolerance)
+        hi = bisect.bisect_right(self._keys, size_x + tolerance)
+
+        found = []
+
+        for d in dims[lo:hi]:
+            diff = difference(d)
+
+            if diff is not None and diff <= tolerance:
+                found.append((diff, d))
+
+        found.sort(key=lambda f: (f[0], f[1].id))
+        return found
+
+    def nearest(self, size_x, size_y, limit=1, **criteria):
+        """
+        Find the limit presets closest to labels size_x by size_y mm that
+        meet the criteria, however far off they are.
+
+        Returns a list of (difference, PresetDims), closest first
+        """
+
+        dims = self._load()
+        keys = self._keys
+        difference = self._matcher(size_x, size_y, criteria)
+
+        # walk outwards from the search width, nearest width first, until
+        # the width alone is further off than the worst of the best found
+        below = bisect.bisect_left(keys, size_x) - 1
+        above = below + 1
+
+        best = []
+
+        while below >= 0 or above < len(dims):
+
+            if above >= len(dims) or (
+                    below >= 0 and
+                    size_x - keys[below] <= keys[above] - size_x):
+                n = below
+                below -= 1
+            else:
+                n = above
+                above += 1
+
+            if len(best) >= limit and abs(keys[n] - size_x) > best[-1][0]:
+                break
+
+            diff = difference(dims[n])
+
+            if diff is None or (len(best) >= limit and diff > best[-1][0]):
+                continue
+
+            best.append((diff, dims[n]))
+            best.sort(key=lambda f: (f[0], f[1].id))
+            del best[limit:]
+
+        return best
+
+
+DIMENSIONS = DimensionIndex(PRESETS)
+
+
+# A layout found by fit_layout, in the units it was given. gutter is the
+# narrowest gap between neighbouring labels (None for a single label), and
+# alt_count the number of labels in the alternate rows of a 'hex' layout
+FitCandidate = namedtuple('FitCandidate', [
+        'count', 'layout', 'rotated', 'size_x', 'size_y',
+        'margin_l', 'margin_t', 'pitch_x', 'pitch_y', 'count_x', 'count_y',
+        'alt_count', 'gutter'])
+
+# Slack in fitting, for rounding in the sizes given
+_FIT_EPSILON = 1e-9
+
+
+def _fit_count(length, size, gutter):
+    """
+    The most labels of a size that fit in a length, with at least the
+    given gutter between them
+    """
+
+    if size > length + _FIT_EPSILON:
+        return 0
+
+    return int((length + gutter) / (size + gutter) + _FIT_EPSILON)
+
+
+def _fit_axis(length, size, count, min_gutter):
+    """
+    Space count labels along a usable length: the spare space is shared
+    evenly between the gutters and the two margins, but the gutters are
+    at least min_gutter, and the labels are centred.
+
+    Returns (margin, pitch, gutter), the margin being from the start of the
+    usable length
+    """
+
+    spare = length - count * size
+
+    if count == 1:
+        return spare / 2, size, None
+
+    gutter = max(min_gutter, spare / (count + 1))
+
+    return (spare - (count - 1) * gutter) / 2, size + gutter, gutter
+
+
+class _FitFamily(object):
+    """
+    One kind of layout to fit (a layout, in one orientation), giving the
+    candidate for any number of labels across and down
+    """
+
+    def __init__(self, layout, rotated, size_x, size_y, usable_x, usable_y,
+                 min_gutter, printer_margin):
+
+        self.layout = layout
+        self.rotated = rotated
+        self.size_x, self.size_y = size_x, size_y
+        self.usable_x, self.usable_y = usable_x, usable_y
+        self.min_gutter = min_gutter
+        self.printer_margin = printer_margin
+
+        if layout == 'hex':
+            # round labels touch (but for the gutter) their neighbours in
+            # the row and in the rows above and below
+            self.pitch_x = size_x + min_gutter
+            self.pitch_y = self.pitch_x * math.sqrt(3) / 2
+            self.max_x = _fit_count(usable_x, size_x, min_gutter)
+            self.max_y = _fit_count(usable_y, size_y,
+                                    self.pitch_y - size_y)
+            # a single row is just a regular grid
+            self.min_y = 2
+        else:
+            self.max_x = _fit_count(usable_x, size_x, min_gutter)
+            self.max_y = _fit_count(usable_y, size_y, min_gutter)
+            self.min_y = 1
+
+    def _alt_count(self, count_x):
+        """
+        Labels in the offset rows: as many as in the others, if the offset
+        leaves room
+        """
+
+        width = self.size_x + (count_x - 0.5) * self.pitch_x
+
+        return count_x if width <= self.usable_x + _FIT_EPSILON \
+            else count_x - 1
+
+    def count(self, count_x, count_y):
+
+        if self.layout == 'hex':
+            return ((count_y + 1) // 2 * count_x +
+                    count_y // 2 * self._alt_count(count_x))
+
+        return count_x * count_y
+
+    def candidate(self, count_x, count_y):
+
+        pm = self.printer_margin
+
+        if self.layout == 'hex':
+            alt_count = self._alt_count(count_x)
+
+            width = self.size_x + (count_x - 1) * self.pitch_x
+            if alt_count == count_x:
+                width += self.pitch_x / 2
+
+            height = self.size_y + (count_y - 1) * self.pitch_y
+
+            return FitCandidate(
+                    self.count(count_x, count_y), 'hex', self.rotated,
+                    self.size_x, self.size_y,
+                    pm + (self.usable_x - width) / 2,
+                    pm + (self.usable_y - height) / 2,
+                    self.pitch_x, self.pitch_y, count_x, count_y,
+                    alt_count, self.min_gutter)
+
+        margin_l, pitch_x, gutter_x = _fit_axis(
+                self.usable_x, self.size_x, count_x, self.min_gutter)
+        margin_t, pitch_y, gutter_y = _fit_axis(
+                self.usable_y, self.size_y, count_y, self.min_gutter)
+
+        gutters = [g for g in (gutter_x, gutter_y) if g is not None]
+
+        return FitCandidate(
+                count_x * count_y, 'reg', self.rotated,
+                self.size_x, self.size_y, pm + margin_l, pm + margin_t,
+                pitch_x, pitch_y, count_x, count_y, 0,
+                min(gutters) if gutters else None)
+
+
+def _fit_rank(candidate):
+    """
+    Sort key for fitted layouts: most labels first, then the widest
+    gutters, then unrotated and regular layouts
+    """
+
+    gutter = candidate.gutter if candidate.gutter is not None else math.inf
+
+    return (-candidate.count, -gutter, candidate.rotated,
+            candidate.layout != 'reg')
+
+
+def fit_layout(size_x, size_y, page_x, page_y, min_gutter=0,
+               printer_margin=0, round_labels=False, rotate=False, limit=5):
+    """
+    Find the layouts that fit the most labels of the given size on a page,
+    with at least min_gutter between labels and leaving printer_margin
+    clear all round, the labels being centred on the page. All lengths are
+    in the same units.
+
+    Regular grids are always tried, and hex-packed rows too for circular
+    labels; with rotate, the labels are also tried turned through 90
+    degrees.
+
+    The counts across and down are searched best first, from the most that
+    fit along each axis, one fewer at a time, so only the combinations that
+    could still make the best few candidates are looked at.
+
+    Returns up to limit FitCandidates, best first
+    """
+
+    usable_x = page_x - 2 * printer_margin
+    usable_y = page_y - 2 * printer_margin
+
+    orientations = [(False, size_x, size_y)]
+
+    if rotate and size_x != size_y:
+        orientations.append((True, size_y, size_x))
+
+    families = []
+
+    for rotated, sx, sy in orientations:
+
+        layouts = ['reg']
+
+        if round_labels and sx == sy:
+            layouts.append('hex')
+
+        families.extend(
+                _FitFamily(layout, rotated, sx, sy, usable_x, usable_y,
+                           min_gutter, printer_margin)
+                for layout in layouts)
+
+    heap = []
+    seen = set()
+
+    def push(n, count_x, count_y):
+
+        family = families[n]
+
+        if count_x < 1 or count_y < family.min_y or \
+                (n, count_x, count_y) in seen:
+            return
+
+        seen.add((n, count_x, count_y))
+        heapq.heappush(heap, (-family.count(count_x, count_y), n,
+                              count_x, count_y))
+
+    for n, family in enumerate(families):
+        push(n, family.max_x, family.max_y)
+
+    found = []
+
+    # fewer labels along either axis never makes for more labels, so once
+    # there are enough candidates, the rest can only be as good if they tie
+    while heap and (len(found) < limit or
+                    -heap[0][0] >= found[limit - 1].count):
+
+        _, n, count_x, count_y = heapq.heappop(heap)
+
+        found.append(families[n].candidate(count_x, count_y))
+        found.sort(key=_fit_rank)
+
+        push(n, count_x - 1, count_y)
+        push(n, count_x, count_y - 1)
+
+    return found[:limit]
@@ -20,9 +20,31 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
+import contextlib
+import copy
+import csv
+import functools
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+
 import inkex
 from lxml import etree
 
+# The catalog and layout maths live in their own module, which doesn't
+# need inkex. Names are re-exported here for existing users
+from label_geometry import (  # noqa: F401
+        PRESET_FILES, PRESET_PATH_ENV, Preset, PresetIndex, PRESETS,
+        PAGE_SIZES, parse_page_size, LAYOUTS, layout_params, LabelGrid,
+        preset_opts, custom_opts, regular_guides, UNIT_MM, DIMENSIONS,
+        fit_layout)
+
+# Number of auto-fit candidates to list
+AUTOFIT_CANDIDATES = 5
+
 # Colours to use for the guides
 GUIDE_COLOURS = {
         'edge': '#00A000',
@@ -30,146 +52,341 @@ GUIDE_COLOURS = {
         'inset': '#0000A0'
 }
 
-# Preset list
-# Regular grids defined as:
-#       'reg', unit, page_szie, l marg, t marg, X size, Y size,
-#       X pitch, Y pitch, Number across, Number down, shapes
-PRESETS = {
-    # Rounded rectangular labels in grid layout
-    'L7167':        ['reg', 'mm', 'a4', 5.2, 3.95, 199.6, 289.1, 199.6, 289.1, 1, 1, 'rrect'],
-    'L7168':        ['reg', 'mm', 'a4', 5.2, 5, 199.6, 143.5, 199.6, 143.5, 1, 2, 'rrect'],
-    'L7169':        ['reg', 'mm', 'a4', 4.65, 9.5, 99.1, 139, 101.6, 139, 2, 2, 'rrect'],
-    'L7701':        ['reg', 'mm', 'a4', 9, 24.5, 192, 62, 192, 62, 1, 4, 'rrect'],
-    'L7171':        ['reg', 'mm', 'a4', 5, 28.5, 200, 60, 200, 60, 1, 4, 'rrect'],
-    'L7166':        ['reg', 'mm', 'a4', 4.65, 8.85, 99.1, 93.1, 101.6, 93.1, 2, 3, 'rrect'],
-    'L4760':        ['reg', 'mm', 'a4', 9, 12, 192, 39, 192, 39, 1, 7, 'rrect'],
-    'L7165':        ['reg', 'mm', 'a4', 4.65, 13.1, 99.1, 67.7, 101.6, 67.7, 2, 4, 'rrect'],
-    'L7664':        ['reg', 'mm', 'a4', 18, 4.9, 70, 71.8, 104, 71.8, 2, 4, 'rrect'],
-    'L7667':        ['reg', 'mm', 'a4', 38.5, 15.3, 133, 29.6, 133, 29.6, 1, 9, 'rrect'],
-    'L7173':        ['reg', 'mm', 'a4', 4.65, 6, 99.1, 57, 101.6, 57, 2, 5, 'rrect'],
-    'J5103':        ['reg', 'mm', 'a4', 4.75, 13.5, 38.1, 135, 40.6, 135, 5, 2, 'rrect'],
-    'L7666':        ['reg', 'mm', 'a4', 23, 18.5, 70, 52, 94, 52, 2, 5, 'rrect'],
-    'L7783':        ['reg', 'mm', 'a4', 7.85, 21.75, 95.8, 50.7, 98.5, 50.7, 2, 5, 'rrect'],
-    'L7164':        ['reg', 'mm', 'a4', 7.25, 4.5, 63.5, 72, 66, 72, 3, 4, 'rrect'],
-    'L7671':        ['reg', 'mm', 'a4', 27.55, 9.3, 76.2, 46.4, 78.7, 46.4, 2, 6, 'rrect'],
-    'L7177':        ['reg', 'mm', 'a4', 4.65, 21.6, 99.1, 42.3, 101.6, 42.3, 2, 6, 'rrect'],
-    'L7163':        ['reg', 'mm', 'a4', 4.65, 15.15, 99.1, 38.1, 101.6, 38.1, 2, 7, 'rrect'],
-    'L7668':        ['reg', 'mm', 'a4', 13.5, 21.25, 59, 50.9, 62, 50.9, 3, 5, 'rrect'],
-    'L7162':        ['reg', 'mm', 'a4', 4.65, 12.9, 99.1, 33.9, 101.6, 33.9, 2, 8, 'rrect'],
-    'L7674':        ['reg', 'mm', 'a4', 32.5, 12.5, 145, 17, 145, 17, 1, 16, 'rrect'],
-    'L7161':        ['reg', 'mm', 'a4', 7.25, 8.7, 63.5, 46.6, 66, 46.6, 3, 6, 'rrect'],
-    'L7172':        ['reg', 'mm', 'a4', 3.75, 13.5, 100, 30, 102.5, 30, 2, 9, 'rrect'],
-    'J5101':        ['reg', 'mm', 'a4', 4.75, 10.5, 38.1, 69, 40.6, 69, 5, 4, 'rrect'],
-    'L7160':        ['reg', 'mm', 'a4', 7.25, 15.15, 63.5, 38.1, 66, 38.1, 3, 7, 'rrect'],
-    'L7159':        ['reg', 'mm', 'a4', 7.25, 12.9, 63.5, 33.9, 66, 33.9, 3, 8, 'rrect'],
-    'L7665':        ['reg', 'mm', 'a4', 22, 21.6, 72, 21.15, 94, 21.15, 2, 12, 'rrect'],
-    'L7170':        ['reg', 'mm', 'a4', 38, 16.5, 134, 11, 134, 11, 1, 24, 'rrect'],
-    'L6011':        ['reg', 'mm', 'a4', 7.25, 15.3, 63.5, 29.6, 66, 29.6, 3, 9, 'rrect'],
-    'LP33_53':      ['reg', 'mm', 'a4', 21, 17.5, 54, 22, 57, 24, 3, 11, 'rrect'],
-    'LP36_49':      ['reg', 'mm', 'a4', 4.8, 15.3, 48.9, 29.6, 50.5, 29.6, 4, 9, 'rrect'],
-    'L7654':        ['reg', 'mm', 'a4', 9.7, 21.5, 45.7, 25.4, 48.3, 25.4, 4, 10, 'rrect'],
-    'L7636':        ['reg', 'mm', 'a4', 9.85, 21.3, 45.7, 21.2, 48.2, 21.2, 4, 12, 'rrect'],
-    'LP56_89':      ['reg', 'mm', 'a4', 8, 8.5, 89, 10, 105, 10, 2, 28, 'rrect'],
-    'L7651':        ['reg', 'mm', 'a4', 4.75, 10.7, 38.1, 21.2, 40.6, 21.2, 5, 13, 'rrect'],
-    'L7656':        ['reg', 'mm', 'a4', 5.95, 15.95, 46, 11.1, 50.7, 12.7, 4, 21, 'rrect'],
-    'L7658':        ['reg', 'mm', 'a4', 8.6, 13.5, 25.4, 10, 27.9, 10, 7, 27, 'rrect'],
-    'L7657':        ['reg', 'mm', 'a4', 4.75, 13.5, 17.8, 10, 20.3, 10, 10, 27, 'rrect'],
-
-    # Rect labels
-    'L7784':        ['reg', 'mm', 'a4', 0, 0, 210, 297, 210, 297, 1, 1, 'rect'],
-    'LP2_105':      ['reg', 'mm', 'a4', 0, 0, 105, 297, 105, 297, 2, 1, 'rect'],
-    '3655':         ['reg', 'mm', 'a4', 0, 0, 210, 148.5, 210, 148.5, 1, 2, 'rect'],
-    'LP3_210':      ['reg', 'mm', 'a4', 0, 0, 210, 99, 210, 99, 1, 3, 'rect'],
-    '3483':         ['reg', 'mm', 'a4', 0, 0, 105, 148.5, 105, 148.5, 2, 2, 'rect'],
-    'LP4_210':      ['reg', 'mm', 'a4', 0, 0, 210, 74.25, 210, 74.25, 1, 4, 'rect'],
-    'LP6_70':       ['reg', 'mm', 'a4', 0, 0, 70, 148.5, 70, 148.5, 3, 2, 'rect'],
-    'LP6_105':      ['reg', 'mm', 'a4', 0, 0, 105, 99, 105, 99, 2, 3, 'rect'],
-    '3427':         ['reg', 'mm', 'a4', 0, 0, 105, 74.25, 105, 74.25, 2, 4, 'rect'],
-    'LP8_105S':     ['reg', 'mm', 'a4', 0, 7.1, 105, 70.7, 105, 70.7, 2, 4, 'rect'],
-    'LP10_105':     ['reg', 'mm', 'a4', 0, 0, 105, 59.4, 105, 59.4, 2, 5, 'rect'],
-    '3425':         ['reg', 'mm', 'a4', 0, 4.625, 105, 57.55, 105, 57.55, 2, 5, 'rect'],
-    'LP12_105':     ['reg', 'mm', 'a4', 0, 0, 105, 49.5, 105, 49.5, 2, 6, 'rect'],
-    '3424':         ['reg', 'mm', 'a4', 0, 4.8, 105, 47.9, 105, 47.9, 2, 6, 'rect'],
-    '3653':         ['reg', 'mm', 'a4', 0, 0, 105, 42.42, 105, 42.42, 2, 7, 'rect'],
-    'LP15_70':      ['reg', 'mm', 'a4', 0, 0, 70, 59.4, 70, 59.4, 3, 5, 'rect'],
-    'LP15_70S':     ['reg', 'mm', 'a4', 0, 21.75, 70, 50.7, 70, 50.7, 3, 5, 'rect'],
-    '3484':         ['reg', 'mm', 'a4', 0, 0, 105, 37.12, 105, 37.12, 2, 8, 'rect'],
-    '3423':         ['reg', 'mm', 'a4', 0, 8.7, 105, 34.95, 105, 34.95, 2, 8, 'rect'],
-    '3652':         ['reg', 'mm', 'a4', 0, 0, 70, 42.42, 70, 42.42, 3, 7, 'rect'],
-    'LP21_70S':     ['reg', 'mm', 'a4', 0, 15.15, 70, 38.1, 70, 38.1, 3, 7, 'rect'],
-    '3474':         ['reg', 'mm', 'a4', 0, 0, 70, 37.12, 70, 37.12, 3, 8, 'rect'],
-    '3422':         ['reg', 'mm', 'a4', 0, 8.7, 70, 34.95, 70, 34.95, 3, 8, 'rect'],
-    'LP24_70LS':    ['reg', 'mm', 'a4', 0, 12.5, 70, 34, 70, 34, 3, 8, 'rect'],
-    '3475':         ['reg', 'mm', 'a4', 0, 4.5, 70, 36, 70, 36, 3, 8, 'rect'],
-    'LP27_70S':     ['reg', 'mm', 'a4', 0, 4.725, 70, 31.95, 70, 31.95, 3, 9, 'rect'],
-    '3489':         ['reg', 'mm', 'a4', 0, 0, 70, 29.7, 70, 29.7, 3, 10, 'rect'],
-    '3421':         ['reg', 'mm', 'a4', 0, 8.8, 70, 25.4, 70, 25.4, 3, 11, 'rect'],
-    'L7409':        ['reg', 'mm', 'a4', 19.5, 21, 57, 15, 57, 15, 3, 17, 'rect'],
-    'LP56_52':      ['reg', 'mm', 'a4', 0, 0, 52.5, 21.21, 52.5, 21.21, 4, 14, 'rect'],
-
-    # Round labels
-    'LP2_115R':     ['reg', 'mm', 'a4', 47.75, 16.65, 114.5, 114.5, 114.5, 149.2, 1, 2, 'circle'],
-    'LP6_88R':      ['reg', 'mm', 'a4', 16, 14.5, 88, 88, 90, 90, 2, 3, 'circle'],
-    'LP6_85R':      ['reg', 'mm', 'a4', 17.5, 16, 85, 85, 90, 90, 2, 3, 'circle'],
-    'LP6_76R':      ['reg', 'mm', 'a4', 27, 31, 76, 76, 80, 79.5, 2, 3, 'circle'],
-    'C2244':        ['reg', 'mm', 'a4', 29.7, 33.9, 72, 72, 78.6, 78.6, 2, 3, 'circle'],
-    'LP8_69R':      ['reg', 'mm', 'a4', 34.5, 6, 69, 69, 72, 72, 2, 4, 'circle'],
-    'L7670':        ['reg', 'mm', 'a4', 5.25, 14.75, 63.5, 63.5, 68, 68, 3, 4, 'circle'],
-    'LP15_51R':     ['reg', 'mm', 'a4', 26.5, 17, 51, 51, 53, 53, 3, 5, 'circle'],
-    'LP24_45R':     ['reg', 'mm', 'a4', 9, 6, 45, 45, 49, 48, 4, 6, 'circle'],
-    'L7780':        ['reg', 'mm', 'a4', 16, 13.5, 40, 40, 46, 46, 4, 6, 'circle'],
-    'LP35_37R':     ['reg', 'mm', 'a4', 8.5, 13, 37, 37, 39, 39, 5, 7, 'circle'],
-    'LP35_35R':     ['reg', 'mm', 'a4', 9.5, 17, 35, 35, 39, 38, 5, 7, 'circle'],
-    'LP40_32R':     ['reg', 'mm', 'a4', 19, 10.35, 32, 32, 35, 34.9, 5, 8, 'circle'],
-    'LP54_29R':     ['reg', 'mm', 'a4', 8, 6, 29, 29, 33, 32, 6, 9, 'circle'],
-    'LP70_25R':     ['reg', 'mm', 'a4', 11.5, 14.5, 25, 25, 27, 27, 7, 10, 'circle'],
-    'LP117_19R':    ['reg', 'mm', 'a4', 11.5, 13, 19, 19, 21, 21, 9, 13, 'circle'],
-    'LP216_13R':    ['reg', 'mm', 'a4', 13.25, 10.25, 13, 13, 15.5, 15.5, 12, 18, 'circle'],
-
-    # Oval labels
-    'LP2_195OV':    ['reg', 'mm', 'a4', 7.5, 8.5, 195, 138, 195, 142, 1, 2, 'circle'],
-    'LP4_90OV':     ['reg', 'mm', 'a4', 14, 12.5, 90, 135, 92, 137, 2, 2, 'circle'],
-    'LP8_90OV':     ['reg', 'mm', 'a4', 9.25, 15.95, 90, 62, 101.5, 67.7, 2, 4, 'circle'],
-    'LP10_95OV':    ['reg', 'mm', 'a4', 7, 8, 95, 53, 101, 57, 2, 5, 'circle'],
-    'LP14_95OV':    ['reg', 'mm', 'a4', 7, 17.5, 95, 34, 101, 38, 2, 7, 'circle'],
-    'LP21_60OV':    ['reg', 'mm', 'a4', 11, 10, 60, 34, 64, 40.5, 3, 7, 'circle'],
-    'LP32_40OV':    ['reg', 'mm', 'a4', 22, 21.5, 40, 30, 42, 32, 4, 8, 'circle'],
-    'LP65_35OV':    ['reg', 'mm', 'a4', 5.975, 13.3, 35.05, 16, 40.75, 21.2, 5, 13, 'circle'],
-
-    # Square labels
-    'LP6_95SQ':     ['reg', 'mm', 'a4', 6.5, 3, 95, 95, 98, 98, 2, 3, 'rrect'],
-    'LP12_65SQ':    ['reg', 'mm', 'a4', 5, 15.5, 65, 65, 67.5, 67, 3, 4, 'rrect'],
-    'LP15_51SQ':    ['reg', 'mm', 'a4', 26.6, 17.2, 51, 51, 52.9, 52.9, 3, 5, 'rrect'],
-    'LP35_37SQ':    ['reg', 'mm', 'a4', 8.5 / 12, 13.3, 37, 37, 39, 38.9, 5, 7, 'rrect'],
-    'LP70_25SQ':    ['reg', 'mm', 'a4', 11.5, 14.5, 25, 25, 27, 27, 7, 10, 'rrect'],
+# Attributes used to tag the guides and layers this extension creates, so
+# they can be found again later without touching anything else
+TAG_PRESET = 'data-label-guides-preset'
+TAG_STAGE = 'data-label-guides-stage'
+TAG_FINGERPRINT = 'data-label-guides-fingerprint'
+
+# Namespaced tag and attribute names, worked out once
+SODIPODI_GUIDE = inkex.addNS('guide', 'sodipodi')
+SVG_PATH = inkex.addNS('path', 'svg')
+SVG_RECT = inkex.addNS('rect', 'svg')
+SVG_USE = inkex.addNS('use', 'svg')
+SVG_CIRCLE = inkex.addNS('circle', 'svg')
+SVG_ELLIPSE = inkex.addNS('ellipse', 'svg')
+INKSCAPE_COLOR = inkex.addNS('color', 'inkscape')
+SODIPODI_ARC_ATTRIBS = [inkex.addNS(a, 'sodipodi')
+                        for a in ['cx', 'cy', 'rx', 'ry', 'type']]
+XLINK_HREF = inkex.addNS('href', 'xlink')
+INKSCAPE_GRID = inkex.addNS('grid', 'inkscape')
+
+# Decimal places for numbers in compact output, by default
+DEFAULT_PRECISION = 3
+
+
+def format_number(value, precision):
+    """
+    Format a number with at most the given number of decimal places,
+    without trailing zeros
+    """
+
+    text = '{:.{}f}'.format(value, max(precision, 0))
+
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+
+    return '0' if text == '-0' else text
+
+
+def _style_attribs(style):
+    """
+    The style attribute for a shape, or none when the shape inherits its
+    style from its layer
+    """
+
+    return {'style': str(inkex.Style(style))} if style is not None else {}
+
+
+# Guide orientation mnemonics
+GUIDE_ORIENTATIONS = {
+        'vert': '1,0',
+        'horz': '0,1'
 }
 
 
-def add_SVG_guide(x, y, orientation, colour, parent):
-    """ Create a sodipodi:guide node on the given parent
+def _emit(parent, tag, base_attribs, per_element):
+    """
+    Append one element to parent for each dict of per-element attributes,
+    on top of a shared set of attributes
     """
 
-    try:
-        # convert mnemonics to actual orientations
-        orientation = {
-                'vert': '1,0',
-                'horz': '0,1'
-        }[orientation]
-    except KeyError:
-        pass
+    make = parent.makeelement
+    elements = []
 
-    attribs = {
-            'position': str(x) + "," + str(y),
-            'orientation': orientation
+    for attribs in per_element:
+        full = dict(base_attribs)
+        full.update(attribs)
+        elements.append(make(tag, full))
+
+    # Add them with plain lxml: newer inkex versions hook extend() to do
+    # per-element ID bookkeeping, and none of these elements have IDs
+    etree.ElementBase.extend(parent, elements)
+    return elements
+
+
+def add_SVG_guides(positions, orientation, colour, parent, tags=None):
+    """ Create sodipodi:guide nodes on the given parent for a batch of
+    (x, y) positions that share an orientation, colour and tags
+    """
+
+    base = {
+            'position': None,
+            'orientation': GUIDE_ORIENTATIONS.get(orientation, orientation)
     }
 
     if colour is not None:
-        attribs[inkex.addNS('color', 'inkscape')] = colour
+        base[INKSCAPE_COLOR] = colour
+
+    if tags:
+        base.update(tags)
+
+    return _emit(parent, SODIPODI_GUIDE, base,
+                 ({'position': str(x) + "," + str(y)} for x, y in positions))
+
+
+def add_SVG_grid(namedview, gid, origin, spacing, colour, unit, tags=None):
+    """ Create an inkscape:grid (rectangular) on the given namedview, with
+    the origin and spacing in user units
+    """
+
+    attribs = {
+            'id': gid,
+            'type': 'xygrid',
+            'originx': str(origin[0]),
+            'originy': str(origin[1]),
+            'spacingx': str(spacing[0]),
+            'spacingy': str(spacing[1]),
+            'units': unit,
+            'color': colour,
+            'empcolor': colour,
+            'visible': 'true',
+            'enabled': 'true',
+    }
+
+    if tags:
+        attribs.update(tags)
+
+    return etree.SubElement(namedview, INKSCAPE_GRID, attribs)
+
+
+def thin_positions(positions, keep, group=1):
+    """
+    Pick keep positions, spread evenly from first to last, out of a list
+    of positions. Positions are taken in groups (e.g. near and far edges of
+    a cell), which are kept or dropped together.
+    """
+
+    groups = [positions[i:i + group] for i in range(0, len(positions), group)]
+    keep = keep // group
+
+    if keep >= len(groups):
+        return list(positions)
+
+    if keep <= 0:
+        return []
+
+    if keep == 1:
+        return list(groups[0])
+
+    step = (len(groups) - 1) / (keep - 1)
+
+    return [p for i in range(keep) for p in groups[round(i * step)]]
+
+
+def draw_SVG_ellipses(rx, ry, centres, style, parent, fmt=str):
+    """ Draw an ellipse of the same size at each of a batch of (cx, cy)
+    centres, sharing one serialised style (None to inherit it), as
+    Inkscape arcs
+    """
+
+    cx_attr, cy_attr, rx_attr, ry_attr, type_attr = SODIPODI_ARC_ATTRIBS
+
+    base = _style_attribs(style)
+    base.update({
+        cx_attr: None,
+        cy_attr: None,
+        rx_attr: fmt(rx),
+        ry_attr: fmt(ry),
+        type_attr: 'arc',
+    })
+
+    return _emit(parent, SVG_PATH, base,
+                 ({cx_attr: fmt(cx), cy_attr: fmt(cy)} for cx, cy in centres))
+
+
+def draw_SVG_circles(rx, ry, centres, style, parent, fmt=str):
+    """ Draw an ellipse of the same size at each of a batch of (cx, cy)
+    centres, sharing one serialised style (None to inherit it), as native
+    <circle> elements, or <ellipse> ones if the radii differ
+    """
+
+    base = _style_attribs(style)
+    base.update({'cx': None, 'cy': None})
+
+    if rx == ry:
+        tag = SVG_CIRCLE
+        base['r'] = fmt(rx)
+    else:
+        tag = SVG_ELLIPSE
+        base.update({'rx': fmt(rx), 'ry': fmt(ry)})
+
+    return _emit(parent, tag, base,
+                 ({'cx': fmt(cx), 'cy': fmt(cy)} for cx, cy in centres))
 
-    etree.SubElement(
-            parent,
-            inkex.addNS('guide', 'sodipodi'),
-            attribs)
+
+def draw_SVG_rects(w, h, round, corners, style, parent, fmt=str):
+    """ Draw a rectangle of the same size at each of a batch of (x, y)
+    top-left corners, sharing one serialised style (None to inherit it)
+    """
+
+    base = _style_attribs(style)
+    base.update({
+        'height':   fmt(h),
+        'width':    fmt(w),
+        'x':        None,
+        'y':        None
+    })
+
+    if round:
+        base['ry'] = fmt(round)
+
+    return _emit(parent, SVG_RECT, base,
+                 ({'x': fmt(x), 'y': fmt(y)} for x, y in corners))
+
+
+def draw_SVG_uses(href, positions, parent, fmt=str):
+    """ Place a <use> clone of the element with the given ID at each of a
+    batch of (x, y) positions
+    """
+
+    base = {
+        XLINK_HREF: '#' + href,
+        'x': None,
+        'y': None
+    }
+
+    return _emit(parent, SVG_USE, base,
+                 ({'x': fmt(x), 'y': fmt(y)} for x, y in positions))
+
+
+class GuideIndex(object):
+    """
+    Index of the guides in a namedview, keyed by orientation and position
+    (quantised to a tolerance in user units).
+
+    This is built once from the guides already in the document, and then
+    used to add new guides, skipping any that would land on top of an
+    existing guide, or of one that was already added in this run.
+    """
+
+    def __init__(self, namedview, tolerance=1e-4):
+
+        self.namedview = namedview
+        self.tolerance = tolerance
+
+        # Number of guides at each key (there may already be duplicates)
+        self._keys = {}
+
+        for guide in namedview.iterfind(inkex.addNS('guide', 'sodipodi')):
+            key = self._element_key(guide)
+
+            if key is not None:
+                self._keys[key] = self._keys.get(key, 0) + 1
+
+    def _element_key(self, guide):
+
+        try:
+            x, y = [float(v) for v in guide.get('position').split(',')]
+        except (AttributeError, ValueError):
+            # not a guide we can make sense of, just leave it alone
+            return None
+
+        return self._key(x, y, guide.get('orientation', ''))
+
+    def _key(self, x, y, orientation):
+
+        # convert mnemonics to actual orientations
+        orientation = GUIDE_ORIENTATIONS.get(orientation, orientation)
+
+        try:
+            ox, oy = [float(v) for v in orientation.split(',')]
+        except ValueError:
+            return None
+
+        def quant(v):
+            return int(round(v / self.tolerance))
+
+        # Vertical and horizontal guides are the same guide anywhere along
+        # their length, whichever way their normal points
+        if oy == 0:
+            return ('v', quant(x))
+        if ox == 0:
+            return ('h', quant(y))
+
+        return ('o', quant(ox), quant(oy), quant(x), quant(y))
+
+    def add_elements(self, elements):
+        """
+        Add ready-made guide elements to the namedview, skipping any that
+        there are already guides at. Anything that isn't a guide (e.g. a
+        grid) is added as it is.
+
+        Returns the number of elements added
+        """
+
+        new = []
+
+        for element in elements:
+
+            if element.tag == SODIPODI_GUIDE:
+                key = self._element_key(element)
+
+                if key in self._keys:
+                    continue
+
+                if key is not None:
+                    self._keys[key] = 1
+
+            new.append(element)
+
+        etree.ElementBase.extend(self.namedview, new)
+        return len(new)
+
+    def add_batch(self, positions, orientation, colour, tags=None):
+        """
+        Add guides at a batch of (x, y) positions with the same orientation,
+        skipping any that there are already guides at.
+
+        Returns the number of guides added
+        """
+
+        new = []
+
+        for x, y in positions:
+            key = self._key(x, y, orientation)
+
+            if key not in self._keys:
+                self._keys[key] = 1
+                new.append((x, y))
+
+        add_SVG_guides(new, orientation, colour, self.namedview, tags)
+        return len(new)
+
+    def remove(self, guide):
+        """
+        Remove a guide element from the namedview and from the index
+        """
+
+        key = self._element_key(guide)
+
+        if key in self._keys:
+            self._keys[key] -= 1
+
+            if not self._keys[key]:
+                del self._keys[key]
+
+        self.namedview.remove(guide)
 
 
 def delete_all_guides(document):
@@ -186,47 +403,298 @@ def delete_all_guides(document):
         nv.remove(element)
 
 
-def draw_SVG_ellipse(rx, ry, cx, cy, style, parent):
+def find_generated(document):
+    """
+    Find every node tagged as created by this extension, in a single pass
+    over the document, grouped by the stage that created it
+    """
 
-    attribs = {
-        'style': str(inkex.Style(style)),
-        inkex.addNS('cx', 'sodipodi'):   str(cx),
-        inkex.addNS('cy', 'sodipodi'):   str(cy),
-        inkex.addNS('rx', 'sodipodi'):   str(rx),
-        inkex.addNS('ry', 'sodipodi'):   str(ry),
-        inkex.addNS('type', 'sodipodi'): 'arc',
-    }
+    by_stage = {}
 
-    etree.SubElement(parent, inkex.addNS('path', 'svg'), attribs)
+    for element in document.xpath('//*[@{}]'.format(TAG_STAGE)):
+        by_stage.setdefault(element.get(TAG_STAGE), []).append(element)
 
+    return by_stage
 
-def draw_SVG_rect(x, y, w, h, round, style, parent):
 
-    attribs = {
-        'style':    str(inkex.Style(style)),
-        'height':   str(h),
-        'width':    str(w),
-        'x':        str(x),
-        'y':        str(y)
-    }
+def delete_generated(document):
+    """
+    Remove every guide and layer that was tagged as created by this
+    extension
+    """
+
+    for elements in find_generated(document).values():
+        for element in elements:
+            element.getparent().remove(element)
 
-    if round:
-        attribs['ry'] = str(round)
 
-    etree.SubElement(parent, inkex.addNS('rect', 'svg'), attribs)
+def draw_SVG_path(d, style, parent):
 
+    attribs = _style_attribs(style)
+    attribs['d'] = d
 
-def add_SVG_layer(parent, gid, label):
+    return etree.SubElement(parent, inkex.addNS('path', 'svg'), attribs)
 
-    layer = etree.SubElement(parent, 'g', {
+
+def rect_path_data(x, y, w, h, round, fmt=str):
+    """ Path data for a (possibly rounded) rectangle, as one closed subpath
+    """
+
+    if not round:
+        return "M {},{} h {} v {} h {} Z".format(
+                fmt(x), fmt(y), fmt(w), fmt(h), fmt(-w))
+
+    r = min(round, w / 2, h / 2)
+    arc = "a {r},{r} 0 0 1 {{}},{{}}".format(r=fmt(r))
+
+    return " ".join([
+        "M {},{}".format(fmt(x + r), fmt(y)),
+        "h {}".format(fmt(w - 2 * r)), arc.format(fmt(r), fmt(r)),
+        "v {}".format(fmt(h - 2 * r)), arc.format(fmt(-r), fmt(r)),
+        "h {}".format(fmt(2 * r - w)), arc.format(fmt(-r), fmt(-r)),
+        "v {}".format(fmt(2 * r - h)), arc.format(fmt(r), fmt(-r)),
+        "Z"])
+
+
+def ellipse_path_data(rx, ry, cx, cy, fmt=str):
+    """ Path data for an ellipse, as one closed subpath of two arcs
+    """
+
+    return "M {},{} a {rx},{ry} 0 1 0 {d},0 a {rx},{ry} 0 1 0 {nd},0 Z".format(
+            fmt(cx - rx), fmt(cy), rx=fmt(rx), ry=fmt(ry), d=fmt(2 * rx),
+            nd=fmt(-2 * rx))
+
+
+def add_SVG_layer(parent, gid, label, tags=None):
+
+    attribs = {
         'id': gid,
         inkex.addNS('groupmode', 'inkscape'): 'layer',
         inkex.addNS('label', 'inkscape'): label
-    })
+    }
+
+    if tags:
+        attribs.update(tags)
+
+    layer = etree.SubElement(parent, 'g', attribs)
 
     return layer
 
 
+def add_SVG_page(namedview, x, y, w, h, tags=None):
+    """ Add an Inkscape (1.2+) page to the document
+    """
+
+    attribs = {
+        'x': str(x),
+        'y': str(y),
+        'width': str(w),
+        'height': str(h)
+    }
+
+    if tags:
+        attribs.update(tags)
+
+    return etree.SubElement(namedview, inkex.addNS('page', 'inkscape'),
+                            attribs)
+
+
+class MergeFields(dict):
+    """
+    Row of merge data, for str.format_map: unknown fields come out empty
+    rather than failing the whole run
+    """
+
+    def __missing__(self, key):
+        return ''
+
+
+class StageProfiler(object):
+    """
+    Records a timing span and the change in guide and element counts for
+    each stage of the effect, plus the number of unit scales that had to be
+    looked up (rather than coming from the cache).
+
+    Counting walks the whole document, so this is only for use when
+    profiling is asked for.
+    """
+
+    def __init__(self, svg, lookup_counter):
+        self.svg = svg
+        self.lookup_counter = lookup_counter
+        self.stages = []
+
+    def _counts(self):
+
+        root = self.svg.getroottree().getroot()
+
+        return (len(root.findall('.//' + inkex.addNS('guide', 'sodipodi'))),
+                sum(1 for _ in root.iter()),
+                self.lookup_counter())
+
+    @contextlib.contextmanager
+    def stage(self, name):
+
+        guides, elements, lookups = self._counts()
+        start = time.perf_counter()
+
+        yield
+
+        elapsed = time.perf_counter() - start
+        guides_after, elements_after, lookups_after = self._counts()
+
+        self.stages.append({
+                'stage': name,
+                'time': elapsed,
+                'guides': guides_after - guides,
+                'elements': elements_after - elements,
+                'scale_lookups': lookups_after - lookups,
+        })
+
+    def report(self, **info):
+
+        report = dict(info)
+        report['total_time'] = sum(s['time'] for s in self.stages)
+        report['stages'] = self.stages
+
+        return report
+
+    def write(self, dest, **info):
+        """
+        Write the report, along with any extra info given, as JSON to a
+        file, or to stderr if dest is '-'
+        """
+
+        report = json.dumps(self.report(**info), indent=2)
+
+        if dest == '-':
+            sys.stderr.write(report + "\n")
+        else:
+            with open(dest, 'w') as f:
+                f.write(report + "\n")
+
+
+# Bump this when the output of any stage changes, to invalidate the
+# fragments cached by earlier versions
+FRAGMENT_CACHE_VERSION = 1
+
+
+def default_cache_dir():
+    """
+    Get the per-user directory to cache fragments in
+    """
+
+    base = (os.environ.get('XDG_CACHE_HOME') or
+            os.environ.get('LOCALAPPDATA') or
+            os.path.join(os.path.expanduser('~'), '.cache'))
+
+    return os.path.join(base, 'label-guides')
+
+
+class FragmentCache(object):
+    """
+    On-disk cache of serialised fragments of output, one file per fragment,
+    named by a hash of everything that went into it.
+
+    Reading an entry marks it as recently used, and once the entries add
+    up to more than max_bytes, the least recently used are removed.
+    """
+
+    SUFFIX = '.xml'
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        # Cached output is only good for the code that produced it
+        sources = [__file__, sys.modules[LabelGrid.__module__].__file__]
+        self.stamp = [FRAGMENT_CACHE_VERSION] + [
+                os.path.getmtime(f) for f in sources if os.path.exists(f)]
+
+    def key(self, *parts):
+        """
+        Get the key for a fragment, from everything it depends on
+        """
+
+        return hashlib.sha1(json.dumps(
+                [self.stamp, parts], sort_keys=True,
+                default=str).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key):
+        """
+        Get the data stored under a key, or None
+        """
+
+        path = self._path(key)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            # mark as recently used
+            os.utime(path)
+        except OSError:
+            return None
+
+        return data
+
+    def put(self, key, data):
+        """
+        Store data under a key, evicting old entries if over the size limit.
+
+        The cache is only an optimisation, so failing to write it isn't an
+        error
+        """
+
+        path = self._path(key)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+
+            with open(tmp, 'wb') as f:
+                f.write(data)
+
+            os.replace(tmp, path)
+            self._evict()
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+
+    def _evict(self):
+
+        entries = []
+
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.SUFFIX):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(e[1] for e in entries)
+
+        # oldest first
+        for _, size, path in sorted(entries):
+
+            if total <= self.max_bytes:
+                break
+
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                total -= size
+
+
+class _NullProfiler(object):
+    """
+    Stands in for a StageProfiler when not profiling
+    """
+
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+
 class LabelGuides(inkex.Effect):
 
     def __init__(self):
@@ -283,11 +751,60 @@ class LabelGuides(inkex.Effect):
         self.arg_parser.add_argument(
                 '--shapes', default='rect',
                 help='Label shapes to draw')
+        self.arg_parser.add_argument(
+                '--layout', default='reg', choices=['reg', 'stag', 'hex'],
+                help='Label layout: regular grid, staggered rows or '
+                     'hex-packed rows')
+        self.arg_parser.add_argument(
+                '--stagger_offset', type=float, default=0,
+                help='Offset of alternate rows (0 for half the X pitch)')
+        self.arg_parser.add_argument(
+                '--stagger_count', type=int, default=0,
+                help='Number of labels in alternate rows '
+                     '(0 for one fewer)')
+        self.arg_parser.add_argument(
+                '--match_preset', type=inkex.Boolean, default=False,
+                help='Use the catalog preset nearest to the custom template '
+                     'instead, if there is one within the match tolerance')
+        self.arg_parser.add_argument(
+                '--match_tolerance', type=float, default=0.5,
+                help='Largest difference in label size or pitch for a '
+                     'preset to match')
+        self.arg_parser.add_argument(
+                '--autofit', type=inkex.Boolean, default=False,
+                help='Work out the margins, pitches and numbers of labels '
+                     'that fit the most labels on the page')
+        self.arg_parser.add_argument(
+                '--autofit_page', default='a4',
+                help='Page size to fit the labels on: a named size (in mm) '
+                     'or WxH in the custom units')
+        self.arg_parser.add_argument(
+                '--min_gutter', type=float, default=0,
+                help='Narrowest gap between fitted labels')
+        self.arg_parser.add_argument(
+                '--printer_margin', type=float, default=0,
+                help='Space to leave clear around the edge of the page '
+                     'when fitting labels')
+        self.arg_parser.add_argument(
+                '--autofit_rotate', type=inkex.Boolean, default=False,
+                help='Also try fitting the labels turned through 90 degrees')
+        self.arg_parser.add_argument(
+                '--autofit_candidate', type=int, default=1,
+                help='Which of the ranked fitted layouts to use (1 for the '
+                     'best)')
 
         # GENERAL DRAWING OPTIONS
         self.arg_parser.add_argument(
                 '--delete_existing_guides', type=inkex.Boolean, default=False,
                 help='Delete existing guides from document')
+        self.arg_parser.add_argument(
+                '--delete_generated', type=inkex.Boolean, default=False,
+                help='Delete only the guides and outline layers created '
+                     'by earlier runs of this extension')
+        self.arg_parser.add_argument(
+                '--update_existing', type=inkex.Boolean, default=True,
+                help='Update guides and outline layers from earlier runs '
+                     'in place, redrawing only what has changed')
         self.arg_parser.add_argument(
                 '--draw_edge_guides', type=inkex.Boolean, default=True,
                 help='Draw guides at label edges')
@@ -304,7 +821,7 @@ class LabelGuides(inkex.Effect):
                 '--draw_shapes', type=inkex.Boolean, default=True,
                 help='Draw label outline shapes')
         self.arg_parser.add_argument(
-                '--shape_inset',  default=5,
+                '--shape_inset', type=float, default=5,
                 help='Inset to use for inset shapes')
         self.arg_parser.add_argument(
                 '--draw_inset_shapes', type=inkex.Boolean, default=True,
@@ -312,27 +829,99 @@ class LabelGuides(inkex.Effect):
         self.arg_parser.add_argument(
                 '--set_page_size', type=inkex.Boolean, default=True,
                 help='Set page size (presets only)')
+        self.arg_parser.add_argument(
+                '--guide_budget', type=int, default=0,
+                help='Most guides to draw in each guide stage (0 for no '
+                     'limit)')
+        self.arg_parser.add_argument(
+                '--over_budget', default='grid', choices=['grid', 'thin'],
+                help='What to draw for a guide stage over the budget: an '
+                     'Inkscape grid, or fewer guides')
+        self.arg_parser.add_argument(
+                '--fragment_cache', type=inkex.Boolean, default=False,
+                help='Cache generated guides and outlines on disk, and '
+                     'reuse them when the same template is drawn again')
+        self.arg_parser.add_argument(
+                '--fragment_cache_dir', default='',
+                help='Directory for the fragment cache (default: per-user '
+                     'cache directory)')
+        self.arg_parser.add_argument(
+                '--fragment_cache_size', type=float, default=100,
+                help='Most space the fragment cache may use, in MB')
+        self.arg_parser.add_argument(
+                '--profile', default='',
+                help='Write per-stage timings and counts as JSON to this '
+                     'file ("-" for stderr)')
 
-    def _to_uu(self, val, unit):
-        """
-        Transform a value in given units to User Units
-        """
-        return self.svg.unittouu(str(val) + unit)
+        # SHAPE OUTPUT OPTIONS
+        self.arg_parser.add_argument(
+                '--shape_output', default='elements',
+                choices=['elements', 'instanced', 'path'],
+                help='How to write label shapes: one element per label, '
+                     'one shared definition placed with <use>, or one '
+                     'compound path per layer')
+        self.arg_parser.add_argument(
+                '--compact', type=inkex.Boolean, default=False,
+                help='Write label shapes compactly: numbers rounded to '
+                     '--precision places, circles and ellipses as native '
+                     'elements, and the style set once on each outline '
+                     'layer')
+        self.arg_parser.add_argument(
+                '--precision', type=int, default=DEFAULT_PRECISION,
+                help='Decimal places for numbers in compact output')
+
+        # MAIL MERGE OPTIONS
+        self.arg_parser.add_argument(
+                '--merge_csv', default='',
+                help='CSV file (with a header row) to fill the labels from')
+        self.arg_parser.add_argument(
+                '--merge_format', default='',
+                help='Text for each label, with {column} placeholders and '
+                     '\\n for new lines (default: every column, one per '
+                     'line)')
+        self.arg_parser.add_argument(
+                '--merge_font_size', type=float, default=10,
+                help='Font size (pt) for merged text')
+        self.arg_parser.add_argument(
+                '--merge_template_id', default='',
+                help='ID of an object drawn in the first label, to be '
+                     'cloned into every other label')
+        self.arg_parser.add_argument(
+                '--merge_padding', type=float, default=5,
+                help='Space between the label edges and the merged text, '
+                     'in the template units')
 
-    def _get_page_size(self, size):
+        self.scale_lookups = 0
+        self._uu_scales = {}
+        self.profiler = _NullProfiler()
+
+    def _uu_scale(self, unit):
         """
-        Get a page size from a definition entry - can be in the form
-        [x, y], or a string (one of ['a4'])
+        Get the number of User Units in one of the given unit.
+
+        This is only worked out (by parsing through unittouu) once for each
+        unit and document scale, after that it comes from a cache.
         """
 
-        if isinstance(size, (list,)):
-            # Explicit size
-            return size
-        elif size == "a4":
-            return [210, 297]
+        svg = self.svg
+        key = (unit, svg.get('width'), svg.get('height'), svg.get('viewBox'))
+
+        try:
+            return self._uu_scales[key]
+        except KeyError:
+            pass
+
+        self.scale_lookups += 1
+        scale = svg.unittouu('1' + unit)
+
+        self._uu_scales[key] = scale
+        return scale
 
-        # Failed to find a useful size, None will inhibit setting the size
-        return None
+    def _to_uu(self, val, unit):
+        """
+        Transform a value in given units to User Units
+        """
+        return float(val) * self._uu_scale(unit)
 
     def _set_SVG_page_size(self, document, x, y, unit):
         """
@@ -357,108 +946,223 @@ class LabelGuides(inkex.Effect):
         Read custom label geometry options and produce
         a dictionary of parameters for ingestion
         """
-        unit = options.units
-
-        custom_opts = {
-                'units': options.units,
-                'page_size': None,
-                'margin': {
-                    'l': self._to_uu(options.margin_l, unit),
-                    't': self._to_uu(options.margin_t, unit)
-                },
-                'size': {
-                    'x': self._to_uu(options.size_x, unit),
-                    'y': self._to_uu(options.size_y, unit)
-                },
-                'pitch': {
-                    'x': self._to_uu(options.pitch_x, unit),
-                    'y': self._to_uu(options.pitch_y, unit)
-                },
-                'count': {
-                    'x': options.count_x,
-                    'y': options.count_y
-                },
-                'shapes': options.shapes,
-                'corner_rad': None,
-        }
 
-        return custom_opts
+        return custom_opts(
+                options.units,
+                options.margin_l, options.margin_t,
+                options.size_x, options.size_y,
+                options.pitch_x, options.pitch_y,
+                options.count_x, options.count_y,
+                options.shapes, options.layout,
+                options.stagger_offset, options.stagger_count,
+                uu_scale=self._uu_scale)
+
+    def _autofit_page(self, options):
+        """
+        Get the page size to fit labels on, in the custom units
+        """
+
+        name = options.autofit_page.strip().lower()
+        size = parse_page_size(name)
+
+        if size is None:
+            raise inkex.AbortExtension(
+                    "Unknown page size: " + options.autofit_page)
+
+        if name in PAGE_SIZES:
+            # named sizes are in mm
+            size = [v / UNIT_MM[options.units] for v in size]
+
+        return [float(size[0]), float(size[1])]
+
+    def _fit_custom_options(self, options):
+        """
+        Fit as many custom labels as possible on the auto-fit page, and
+        list the best few layouts found.
+
+        Returns a copy of the options, with the margins, pitches, counts
+        and layout of the chosen layout, and the page size
+        """
+
+        page = self._autofit_page(options)
+
+        candidates = fit_layout(
+                options.size_x, options.size_y, page[0], page[1],
+                options.min_gutter, options.printer_margin,
+                round_labels=options.shapes == 'circle',
+                rotate=options.autofit_rotate,
+                limit=max(AUTOFIT_CANDIDATES, options.autofit_candidate))
+
+        if not candidates:
+            raise inkex.AbortExtension(
+                    "{:g} x {:g}{} labels don't fit on a {:g} x {:g}{} page"
+                    .format(options.size_x, options.size_y, options.units,
+                            page[0], page[1], options.units))
+
+        choice = min(max(options.autofit_candidate, 1), len(candidates))
+
+        lines = ["Auto-fit layouts (using {}):".format(choice)]
+
+        for n, c in enumerate(candidates, 1):
+
+            desc = "{}: {} labels, {} x {} {}".format(
+                    n, c.count, c.count_x, c.count_y,
+                    "hex-packed rows" if c.layout == 'hex' else "grid")
+
+            if c.gutter is not None:
+                desc += ", gutter {:.3g}{}".format(c.gutter, options.units)
+
+            if c.rotated:
+                desc += ", rotated"
+
+            lines.append("  " + desc)
+
+        self.msg("\n".join(lines))
+
+        best = candidates[choice - 1]
+
+        fitted = copy.copy(options)
+
+        for name in ('size_x', 'size_y', 'margin_l', 'margin_t',
+                     'pitch_x', 'pitch_y', 'count_x', 'count_y', 'layout'):
+            setattr(fitted, name, getattr(best, name))
+
+        fitted.stagger_offset = 0
+        fitted.stagger_count = best.alt_count
+
+        return fitted, page
+
+    def _match_preset(self, options):
+        """
+        Find the catalog preset nearest to a custom template, with the same
+        layout, number of labels across and down and kind of shape.
+
+        Returns its ID, or None if there's none within the match tolerance
+        """
+
+        scale = UNIT_MM[options.units]
+        multi = {'x': options.count_x > 1, 'y': options.count_y > 1}
+
+        matches = DIMENSIONS.nearest(
+                options.size_x * scale, options.size_y * scale,
+                # the pitch means nothing with only one label
+                pitch_x=options.pitch_x * scale if multi['x'] else None,
+                pitch_y=options.pitch_y * scale if multi['y'] else None,
+                count_x=options.count_x, count_y=options.count_y,
+                layout=options.layout,
+                shapes=(['circle'] if options.shapes == 'circle'
+                        else ['rect', 'rrect']))
+
+        if not matches:
+            self.msg("No preset has that layout of labels")
+            return None
+
+        diff, dims = matches[0]
+
+        if diff > options.match_tolerance * scale + 1e-9:
+            self.msg("No preset within {:g}{}: the nearest is {}, {:.3g}{} "
+                     "off".format(options.match_tolerance, options.units,
+                                  dims.id, diff / scale, options.units))
+            return None
+
+        self.msg("Using preset {}".format(dims.id))
+        return dims.id
 
     def _construct_preset_opts(self, preset_type, preset_id, options):
         """Construct an options object for a preset label template
         """
-        preset = PRESETS[preset_id]
-
-        unit = preset[1]
-
-        opts = {
-                'units': unit,
-                'page_size': self._get_page_size(preset[2]),
-                'margin': {
-                    'l': self._to_uu(preset[3], unit),
-                    't': self._to_uu(preset[4], unit)
-                 },
-                'size': {
-                    'x': self._to_uu(preset[5], unit),
-                    'y': self._to_uu(preset[6], unit)
-                },
-                'pitch': {
-                    'x': self._to_uu(preset[7], unit),
-                    'y': self._to_uu(preset[8], unit)
-                },
-                'count': {
-                    'x': preset[9],
-                    'y': preset[10]
-                },
-                'shapes': preset[11],
-                'corner_rad': None,
-        }
 
         # add addtional options by preset type
+        corner_rad = None
         if preset_type == "rrect":
-            opts["corner_rad"] = self._to_uu(options.rrect_radius, unit)
+            corner_rad = options.rrect_radius
 
-        return opts
+        return preset_opts(preset_id, self._uu_scale, corner_rad)
 
     def _get_regular_guides(self, label_opts, inset):
         """
-        Get the guides for a set of labels defined by a regular grid
+        Get the guides at the (inset) edges of the columns and rows of
+        labels, for any layout
+        """
+
+        return regular_guides(label_opts, inset)
 
-        This is done so that irregular-grid presets can be defined if
-        needed
+    def _stage_tags(self, stage):
+        """
+        Get the attributes that mark a node as created by the given stage
+        """
+        return {
+                TAG_PRESET: self.preset_id,
+                TAG_STAGE: stage,
+                TAG_FINGERPRINT: self.fingerprints.get(stage, '')
+        }
+
+    def _begin_stage(self, stage, label_opts, *params):
+        """
+        Prepare to draw a stage, given everything that its output depends
+        on.
+
+        When updating in place, and what's in the document from an earlier
+        run was drawn from the same inputs, there is nothing to do and this
+        returns False. Otherwise, the stale guides are removed, the first
+        stale outline layer is emptied to be redrawn into (any others are
+        removed) and this returns True.
         """
 
-        guides = {'v': [], 'h': []}
+        digest = hashlib.sha1(json.dumps(
+                [self.preset_id, stage, label_opts, params,
+                 self.svg.get('viewBox')],
+                sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        fingerprint = digest[:16]
 
-        x = label_opts['margin']['l']
+        self.fingerprints[stage] = fingerprint
+        self.digests[stage] = digest
 
-        # Vertical guides, left to right
-        for x_idx in range(label_opts['count']['x']):
+        if not self.options.update_existing:
+            return True
 
-            l_pos = x + inset
-            r_pos = x + label_opts['size']['x'] - inset
+        existing = self.generated.get(stage, [])
 
-            guides['v'].extend([l_pos, r_pos])
+        if existing and all(el.get(TAG_FINGERPRINT) == fingerprint
+                            for el in existing):
+            return False
 
-            # Step over to next label
-            x += label_opts['pitch']['x']
+        for element in existing:
 
-        # Horizontal guides, bottom to top
-        y = label_opts['margin']['t']
+            if element.tag == inkex.addNS('guide', 'sodipodi'):
+                self.guide_index.remove(element)
 
-        for y_idx in range(label_opts['count']['y']):
+            elif (element.get(inkex.addNS('groupmode', 'inkscape')) ==
+                    'layer' and stage not in self.reuse_layers):
+                # Keep the layer (and its place in the z-order), but empty
+                for child in list(element):
+                    element.remove(child)
 
-            t_pos = y + inset
-            b_pos = y + label_opts['size']['y'] - inset
+                self.reuse_layers[stage] = element
 
-            guides['h'].extend([t_pos, b_pos])
+            else:
+                element.getparent().remove(element)
 
-            # Step over to next label
-            y += label_opts['pitch']['y']
+        return True
 
-        return guides
+    def _drop_stage(self, stage):
+        """
+        Remove what an earlier run drew for a stage that is now turned off,
+        so that the document reflects the current options
+        """
+
+        if not self.options.update_existing:
+            return
+
+        for element in self.generated.pop(stage, []):
 
-    def _draw_label_guides(self, document, label_opts, inset, colour):
+            if element.tag == SODIPODI_GUIDE:
+                self.guide_index.remove(element)
+            else:
+                element.getparent().remove(element)
+
+    def _draw_label_guides(self, document, label_opts, inset, colour,
+                           stage):
         """
         Draws label guides from a regular guide description object
         """
@@ -467,80 +1171,344 @@ class LabelGuides(inkex.Effect):
 
         guides = self._get_regular_guides(label_opts, inset)
 
-        # Get parent tag of the guides
-        nv = self.svg.namedview
-
-        # Draw vertical guides
-        for g in guides['v']:
-            add_SVG_guide(g, 0, 'vert', colour, nv)
+        # near and far edges of each cell, as offsets into the cell
+        offsets = [(inset, inset),
+                   (label_opts['size']['x'] - inset,
+                    label_opts['size']['y'] - inset)]
 
-        # Draw horizontal guides
-        for g in guides['h']:
-            add_SVG_guide(0, self.svg.viewbox_height - g, 'horz', colour, nv)
+        self._add_stage_guides(label_opts, guides['v'], guides['h'], 2,
+                               offsets, colour, stage)
 
     def _draw_centre_guides(self, document, label_opts, colour):
         """
         Draw guides in the centre of labels defined by the given options
         """
 
-        guides = self._get_regular_guides(label_opts, 0)
-        nv = self.svg.namedview
+        centres = LabelGrid(label_opts).centres()
+
+        offsets = [(label_opts['size']['x'] / 2,
+                    label_opts['size']['y'] / 2)]
 
-        for g in range(0, len(guides['v']), 2):
-            pos = (guides['v'][g] + guides['v'][g + 1]) / 2
-            add_SVG_guide(pos, 0, 'vert', colour, nv)
+        self._add_stage_guides(label_opts, centres['x'].tolist(),
+                               centres['y'].tolist(), 1, offsets, colour,
+                               'centre')
 
-        for g in range(0, len(guides['h']), 2):
-            pos = (guides['h'][g] + guides['h'][g + 1]) / 2
-            add_SVG_guide(0, self.svg.viewbox_height - pos, 'horz', colour, nv)
+    def _add_stage_guides(self, label_opts, v, h, group, offsets, colour,
+                          stage):
+        """
+        Add the vertical and horizontal guides of a stage, keeping to the
+        guide budget.
 
-    def _draw_shapes(self, document, label_opts, inset):
+        Over the budget, a regular grid gets one Inkscape grid per offset
+        into the cells instead, which puts lines in the same places, and
+        anything else gets an evenly thinned set of guides.
+        """
+
+        tags = self._stage_tags(stage)
+        budget = self.options.guide_budget
+        pitch = (label_opts['pitch']['x'], label_opts['pitch']['y'])
+        use_grids = False
+
+        if budget > 0 and len(v) + len(h) > budget:
+
+            if (self.options.over_budget == 'grid' and
+                    label_opts.get('layout', {}).get('type', 'reg') == 'reg'
+                    and pitch[0] > 0 and pitch[1] > 0):
+                use_grids = True
+            else:
+                keep_v = budget * len(v) // (len(v) + len(h))
+                v = thin_positions(v, keep_v, group)
+                h = thin_positions(h, budget - keep_v, group)
+
+        vh = self.svg.viewbox_height
+
+        def build(parent, add_guides):
+
+            if use_grids:
+                self._add_stage_grids(label_opts, pitch, offsets, colour,
+                                      tags, parent)
+                return
+
+            # Draw vertical guides
+            add_guides([(g, 0) for g in v], 'vert', colour, tags)
+
+            # Draw horizontal guides
+            add_guides([(0, vh - g) for g in h], 'horz', colour, tags)
+
+        if not self.fragment_cache:
+            build(self.svg.namedview, self.guide_index.add_batch)
+            return
+
+        # Build (or fetch) every guide of the stage, then add the ones
+        # that don't double up on guides already in the document
+        container = self.svg.namedview.makeelement(
+                inkex.addNS('g', 'svg'),
+                nsmap={k: inkex.NSS[k] for k in ['svg', 'sodipodi',
+                                                 'inkscape']})
+
+        def build_fragment(parent):
+            build(parent, lambda positions, orientation, colour, tags:
+                  add_SVG_guides(positions, orientation, colour, parent,
+                                 tags))
+
+        self._cached_fragment(stage, container, build_fragment)
+        self.guide_index.add_elements(list(container))
+
+    def _add_stage_grids(self, label_opts, pitch, offsets, colour, tags,
+                         parent):
+        """
+        Add an Inkscape grid at the label pitch for each offset into the
+        cells, skipping any that would fall on the lines of another
+        """
+
+        seen = set()
+
+        for ox, oy in offsets:
+            origin = (label_opts['margin']['l'] + ox,
+                      label_opts['margin']['t'] + oy)
+
+            # grids repeat, so only the origin within one pitch matters
+            key = (round((origin[0] % pitch[0]) / 1e-4),
+                   round((origin[1] % pitch[1]) / 1e-4))
+
+            if key in seen:
+                continue
+
+            seen.add(key)
+
+            add_SVG_grid(parent,
+                         self.svg.get_unique_id("labelGrid"), origin, pitch,
+                         colour, label_opts['units'], tags)
+
+    def _draw_shapes(self, document, label_opts, inset, stage):
         """
         Draw label shapes from a regular grid
         """
 
+        fmt = str
+
+        if self.options.compact:
+            fmt = functools.partial(format_number,
+                                    precision=self.options.precision)
+
         style = {
                 'stroke': '#000000',
-                'stroke-width': self._to_uu(1, "px"),
+                'stroke-width': fmt(self._to_uu(1, "px")),
                 'fill': "none"
         }
 
         inset = self._to_uu(inset, label_opts['units'])
 
-        guides = self._get_regular_guides(label_opts, 0)
+        grid = LabelGrid(label_opts)
         shape = label_opts['shapes']
 
-        shapeLayer = add_SVG_layer(
-                self.document.getroot(),
-                self.svg.get_unique_id("outlineLayer"),
-                "Label outlines")
+        if stage in self.reuse_layers:
+            shapeLayer = self.reuse_layers[stage]
+            shapeLayer.attrib.update(self._stage_tags(stage))
+        else:
+            shapeLayer = add_SVG_layer(
+                    self.document.getroot(),
+                    self.svg.get_unique_id("outlineLayer"),
+                    "Label outlines",
+                    self._stage_tags(stage))
+
+        if self.options.compact:
+            # the shapes all inherit the layer's style
+            shapeLayer.set('style', str(inkex.Style(style)))
+            style = None
+        else:
+            shapeLayer.attrib.pop('style', None)
+
+        if shape == 'circle':
+            rx = grid.size_x / 2 - inset
+            ry = grid.size_y / 2 - inset
+
+            # Cells are placed by their centres
+            offset = (grid.size_x / 2, grid.size_y / 2)
+
+            draw_ellipses = (draw_SVG_circles if self.options.compact
+                             else draw_SVG_ellipses)
+
+            def draw_batch(cells, parent):
+                return draw_ellipses(rx, ry, cells, style, parent, fmt)
+
+            def path_data(x, y):
+                return ellipse_path_data(rx, ry, x, y, fmt)
+
+        elif shape in ["rect", "rrect"]:
+
+            w = grid.size_x - 2 * inset
+            h = grid.size_y - 2 * inset
+
+            # already in UU
+            rnd = label_opts['corner_rad']
+
+            # Cells are placed by their top-left corners
+            offset = (inset, inset)
+
+            def draw_batch(cells, parent):
+                return draw_SVG_rects(w, h, rnd, cells, style, parent, fmt)
+
+            def path_data(x, y):
+                return rect_path_data(x, y, w, h, rnd, fmt)
+
+        else:
+            return
+
+        mode = self.options.shape_output
+
+        if mode == 'instanced':
+            # Define the shape once, and clone it into every cell. The
+            # clones refer to the shape outside the layer, so this isn't
+            # cached
+            proto = draw_batch([(0, 0)], self.svg.defs)[0]
+            proto_id = self.svg.get_unique_id("labelShape")
+            proto.set('id', proto_id)
+            proto.attrib.update(self._stage_tags(stage))
+
+            draw_SVG_uses(proto_id, grid.cells(*offset), shapeLayer, fmt)
+            self._hoist_xlink()
+            return
+
+        def build(layer):
+
+            cells = grid.cells(*offset)
+
+            if mode == 'path':
+                d = " ".join(path_data(x, y) for x, y in cells)
+                draw_SVG_path(d, style, layer)
+
+            else:
+                # draw shapes column by column
+                draw_batch(cells, layer)
+
+        self._cached_fragment(stage, shapeLayer, build)
+
+    def _hoist_xlink(self):
+        """
+        Declare the xlink namespace once on the root, rather than on every
+        <use> that was added. Clones added under a root that already
+        declares it share that declaration, so there's nothing to do then
+        """
+
+        root = self.document.getroot()
+
+        if root.nsmap.get('xlink') != inkex.NSS['xlink']:
+            etree.cleanup_namespaces(root,
+                                     top_nsmap={'xlink': inkex.NSS['xlink']})
+
+    def _merge_cells(self, label_opts):
+        """
+        Get the top-left corners of the cells of one sheet, in the order
+        they are filled: left to right, then top to bottom
+        """
+
+        return LabelGrid(label_opts).rows()
+
+    def _draw_merge(self, document, label_opts, stage):
+        """
+        Fill the label cells with text from the rows of a CSV file, adding
+        a new page each time a sheet is full.
+
+        The CSV is streamed one row at a time. The text style is set once on
+        the layer, and the optional template object is cloned with <use>,
+        so each label only costs a text element (and a clone).
+        """
+
+        cells = self._merge_cells(label_opts)
+
+        if not cells:
+            return
+
+        pad = self._to_uu(self.options.merge_padding, label_opts['units'])
+        font_size = self._to_uu(self.options.merge_font_size, 'pt')
+        line_height = font_size * 1.25
+
+        fmt = self.options.merge_format.replace('\\n', '\n')
 
-        # draw shapes between every set of two guides
-        for xi in range(0, len(guides['v']), 2):
+        page_w = self.svg.viewbox_width
+        page_h = self.svg.viewbox_height
+        page_gap = self._to_uu(10, 'mm')
 
-            for yi in range(0, len(guides['h']), 2):
+        tags = self._stage_tags(stage)
 
-                if shape == 'circle':
-                    cx = (guides['v'][xi] + guides['v'][xi + 1]) / 2
-                    cy = (guides['h'][yi] + guides['h'][yi + 1]) / 2
+        if stage in self.reuse_layers:
+            layer = self.reuse_layers[stage]
+            layer.attrib.update(tags)
+        else:
+            layer = add_SVG_layer(
+                    self.document.getroot(),
+                    self.svg.get_unique_id("mergeLayer"),
+                    "Label merge", tags)
+
+        # Shared text style, inherited by every label
+        layer.set('style', str(inkex.Style({
+                'font-size': font_size,
+                'line-height': 1.25,
+                'font-family': 'sans-serif',
+                'fill': '#000000',
+        })))
+
+        template_id = self.options.merge_template_id
+
+        nv = self.svg.namedview
+        page_tag = inkex.addNS('page', 'inkscape')
+        text_tag = inkex.addNS('text', 'svg')
+        tspan_tag = inkex.addNS('tspan', 'svg')
+
+        page_group = None
+
+        with open(self.options.merge_csv, newline='',
+                  encoding='utf-8-sig') as f:
 
-                    rx = cx - guides['v'][xi] - inset
-                    ry = cy - guides['h'][yi] - inset
+            for n, row in enumerate(csv.DictReader(f)):
 
-                    draw_SVG_ellipse(rx, ry, cx, cy, style, shapeLayer)
+                page, cell = divmod(n, len(cells))
 
-                elif shape in ["rect", "rrect"]:
+                if cell == 0:
+                    page_x = page * (page_w + page_gap)
 
-                    x = guides['v'][xi] + inset
-                    w = guides['v'][xi + 1] - x - inset
+                    if page == 0:
+                        # With multiple pages, the first page needs to be
+                        # defined too, unless the document already has pages
+                        if nv.find(page_tag) is None:
+                            add_SVG_page(nv, 0, 0, page_w, page_h, tags)
+                    else:
+                        add_SVG_page(nv, page_x, 0, page_w, page_h, tags)
 
-                    y = guides['h'][yi] + inset
-                    h = guides['h'][yi + 1] - y - inset
+                    page_group = etree.SubElement(
+                            layer, inkex.addNS('g', 'svg'),
+                            {'transform': 'translate({},0)'.format(page_x)})
 
-                    rnd = self._to_uu(label_opts['corner_rad'],
-                                      label_opts['units'])
+                x, y = cells[cell]
+
+                if template_id and n > 0:
+                    etree.SubElement(page_group, SVG_USE, {
+                        XLINK_HREF: '#' + template_id,
+                        'x': str(x - cells[0][0]),
+                        'y': str(y - cells[0][1])
+                    })
+
+                if fmt:
+                    text = fmt.format_map(MergeFields(row))
+                else:
+                    text = "\n".join(v for v in row.values() if v)
+
+                text_el = etree.SubElement(page_group, text_tag, {
+                    'x': str(x + pad),
+                    'y': str(y + pad + font_size)
+                })
+
+                for i, line in enumerate(text.split('\n')):
+                    tspan = etree.SubElement(text_el, tspan_tag, {
+                        'x': str(x + pad),
+                        'y': str(y + pad + font_size + i * line_height)
+                    })
+                    tspan.text = line
+
+        if template_id:
+            self._hoist_xlink()
 
-                    draw_SVG_rect(x, y, w, h, rnd, style, shapeLayer)
     def _set_page_size(self, document, label_opts):
         """
         Set the SVG page size from the given label template definition
@@ -552,16 +1520,44 @@ class LabelGuides(inkex.Effect):
         if size is not None:
             self._set_SVG_page_size(document, size[0], size[1], unit)
 
-    def effect(self):
+    def _setup(self):
         """
-        Perform the label template generation effect
+        Work out the label options, clear out anything requested and index
+        what is left in the document
         """
 
+        # before anything is drawn, or cleared out
+        if (self.options.merge_csv and
+                not os.path.isfile(self.options.merge_csv)):
+            raise inkex.AbortExtension(
+                    "Can't find the mail merge file: " +
+                    self.options.merge_csv)
+
         preset_type = self.options.preset_tab.strip('"')
 
-        if preset_type == "custom":
+        match = None
+        custom = self.options
+        page = None
+
+        if preset_type == "custom" and self.options.autofit:
+            custom, page = self._fit_custom_options(self.options)
+
+        if preset_type == "custom" and self.options.match_preset:
+            match = self._match_preset(custom)
+
+        if match is not None:
+            # a custom template that's close enough to a preset
+            label_opts = self._construct_preset_opts(
+                    PRESETS[match].shapes, match, self.options)
+            self.preset_id = match
+        elif preset_type == "custom":
             # construct from parameters
-            label_opts = self._read_custom_options(self.options)
+            label_opts = self._read_custom_options(custom)
+            self.preset_id = "custom"
+
+            if page is not None:
+                # so that the page can be set to the one fitted to
+                label_opts['page_size'] = page
         else:
             # construct from a preset
 
@@ -574,33 +1570,173 @@ class LabelGuides(inkex.Effect):
 
             label_opts = self._construct_preset_opts(preset_type, preset_id,
                                                      self.options)
+            self.preset_id = preset_id
 
         if self.options.delete_existing_guides:
             delete_all_guides(self.document)
 
-        # Resize page first, otherwise guides won't be in the right places
-        if self.options.set_page_size:
-            self._set_page_size(self.document, label_opts)
+        if self.options.delete_generated:
+            delete_generated(self.document)
+
+        # Index the guides that are left, so that none get doubled up
+        self.guide_index = GuideIndex(self.svg.namedview)
 
-        if self.options.draw_edge_guides:
-            self._draw_label_guides(self.document, label_opts, 0,
-                                    GUIDE_COLOURS['edge'])
+        # What earlier runs left behind, to be updated in place
+        self.generated = find_generated(self.document)
+        self.fingerprints = {}
+        self.digests = {}
+        self.reuse_layers = {}
 
-        if self.options.draw_centre_guides:
-            self._draw_centre_guides(self.document, label_opts,
-                                     GUIDE_COLOURS['centre'])
+        self.fragment_cache = None
 
-        if self.options.draw_inset_guides and self.options.inset > 0.0:
-            self._draw_label_guides(self.document, label_opts,
-                                    self.options.inset,
-                                    GUIDE_COLOURS['inset'])
+        if self.options.fragment_cache:
+            self.fragment_cache = FragmentCache(
+                    self.options.fragment_cache_dir or default_cache_dir(),
+                    int(self.options.fragment_cache_size * 1024 * 1024))
 
-        if self.options.draw_shapes:
-            self._draw_shapes(self.document, label_opts, 0)
+        return label_opts
 
-        if self.options.draw_inset_shapes:
-            self._draw_shapes(self.document, label_opts,
-                              self.options.shape_inset)
+    def save(self, stream):
+
+        with self.profiler.stage('serialize'):
+            inkex.Effect.save(self, stream)
+
+    def save_raw(self, ret):
+
+        inkex.Effect.save_raw(self, ret)
+
+        if self.options.profile:
+            self.profiler.write(self.options.profile,
+                                preset=getattr(self, 'preset_id', None))
+
+    def _cached_fragment(self, stage, container, build):
+        """
+        Fill container with the output of a stage: from the fragment cache
+        if it has it, otherwise by calling build(container), and storing
+        the result for next time
+        """
+
+        cache = self.fragment_cache
+        key = None
+        data = None
+
+        if cache:
+            svg = self.svg
+            key = cache.key(self.digests[stage], svg.get('width'),
+                            svg.get('height'))
+            data = cache.get(key)
+
+        if data is None:
+            build(container)
+
+            if cache:
+                cache.put(key, etree.tostring(container))
+
+            return container
+
+        cached = inkex.load_svg(io.BytesIO(data)).getroot()
+
+        # IDs have to be unique in this document
+        for element in cached.iter():
+            old_id = element.get('id')
+            if old_id:
+                element.set('id', self.svg.get_unique_id(
+                        old_id.rstrip('0123456789') or 'id'))
+
+        etree.ElementBase.extend(container, list(cached))
+        return container
+
+    def _guide_budget(self):
+        """
+        Get the guide budget options, which the guide stages depend on
+        """
+
+        if self.options.guide_budget > 0:
+            return [self.options.guide_budget, self.options.over_budget]
+
+        return []
+
+    def _output_format(self):
+        """
+        Get the output format options, which the shape stages depend on
+        """
+
+        if self.options.compact:
+            return ['compact', self.options.precision]
+
+        return []
+
+    def effect(self):
+        """
+        Perform the label template generation effect
+        """
+
+        if self.options.profile:
+            self.profiler = StageProfiler(self.svg,
+                                          lambda: self.scale_lookups)
+
+        with self.profiler.stage('setup'):
+            label_opts = self._setup()
+
+        # Resize page first, otherwise guides won't be in the right places
+        with self.profiler.stage('page_size'):
+            if self.options.set_page_size:
+                self._set_page_size(self.document, label_opts)
+
+        with self.profiler.stage('edge_guides'):
+            if not self.options.draw_edge_guides:
+                self._drop_stage('edge')
+            elif self._begin_stage('edge', label_opts,
+                                   *self._guide_budget()):
+                self._draw_label_guides(self.document, label_opts, 0,
+                                        GUIDE_COLOURS['edge'], 'edge')
+
+        with self.profiler.stage('centre_guides'):
+            if not self.options.draw_centre_guides:
+                self._drop_stage('centre')
+            elif self._begin_stage('centre', label_opts,
+                                   *self._guide_budget()):
+                self._draw_centre_guides(self.document, label_opts,
+                                         GUIDE_COLOURS['centre'])
+
+        with self.profiler.stage('inset_guides'):
+            if not (self.options.draw_inset_guides and
+                    self.options.inset > 0.0):
+                self._drop_stage('inset')
+            elif self._begin_stage('inset', label_opts, self.options.inset,
+                                   *self._guide_budget()):
+                self._draw_label_guides(self.document, label_opts,
+                                        self.options.inset,
+                                        GUIDE_COLOURS['inset'], 'inset')
+
+        with self.profiler.stage('shapes'):
+            if not self.options.draw_shapes:
+                self._drop_stage('shapes')
+            elif self._begin_stage('shapes', label_opts,
+                                   self.options.shape_output,
+                                   *self._output_format()):
+                self._draw_shapes(self.document, label_opts, 0, 'shapes')
+
+        with self.profiler.stage('inset_shapes'):
+            if not self.options.draw_inset_shapes:
+                self._drop_stage('inset_shapes')
+            elif self._begin_stage('inset_shapes', label_opts,
+                                   self.options.shape_inset,
+                                   self.options.shape_output,
+                                   *self._output_format()):
+                self._draw_shapes(self.document, label_opts,
+                                  self.options.shape_inset, 'inset_shapes')
+
+        with self.profiler.stage('merge'):
+            if not self.options.merge_csv:
+                self._drop_stage('merge')
+            elif self._begin_stage(
+                    'merge', label_opts, self.options.merge_csv,
+                    os.path.getmtime(self.options.merge_csv),
+                    self.options.merge_format, self.options.merge_font_size,
+                    self.options.merge_template_id,
+                    self.options.merge_padding):
+                self._draw_merge(self.document, label_opts, 'merge')
 
 if __name__ == '__main__':
     LabelGuides().run()
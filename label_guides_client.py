@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+'''
+Label Guides thin client
+
+This is what Inkscape runs for the Label Guides extension. If a warm worker
+(label_guides_worker.py) is running, the job is handed to it over a local
+socket, which saves importing inkex and lxml and setting up the extension
+on every run (this matters most for live preview). Otherwise the extension
+is run in this process as usual and, if asked for with --warm_worker=true,
+a worker is started in the background for the next run. With
+--warm_worker=false, the extension always runs in this process.
+
+Only the standard library is imported until the extension has to be run
+here.
+
+Licenced under the GNU General Public License v2.0
+'''
+
+import json
+import os
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'label_guides_worker.py')
+
+# Message framing: a 4-byte big-endian length, then the payload
+_LENGTH = struct.Struct('!I')
+
+# How long to wait for the worker to accept a job, in seconds
+CONNECT_TIMEOUT = 0.5
+
+# How long to wait for the worker to finish a job before giving up on it
+# and running the job here, in seconds
+JOB_TIMEOUT = 60
+
+# Environment variables that the extension reads, passed to the worker
+JOB_ENV = ['DOCUMENT_PATH', 'LABEL_GUIDES_PRESETS']
+
+
+def _private_dir(parent, name):
+    """
+    Get a directory in parent that only this user can get at, creating it
+    if need be, or None if it belongs to someone else or is open to them
+    """
+
+    path = os.path.join(parent, name)
+
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return None
+
+    st = os.lstat(path)
+
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & 0o077:
+        return None
+
+    return path
+
+
+def worker_address():
+    """
+    Get the address the worker listens on: a per-user Unix socket where
+    there are Unix sockets, otherwise a file holding a local TCP port and
+    an access token. Returns None if there's nowhere private to put it.
+
+    The socket goes in XDG_RUNTIME_DIR, or failing that a directory of this
+    user's own in the (shared) temporary directory
+    """
+
+    if not hasattr(os, 'getuid'):
+        # the temporary directory is already per user on Windows
+        return os.path.join(tempfile.gettempdir(), 'label-guides-{}.port'
+                            .format(os.environ.get('USERNAME', 'user')))
+
+    name = 'label-guides-{}'.format(os.getuid())
+
+    run_dir = os.environ.get('XDG_RUNTIME_DIR') or \
+        _private_dir(tempfile.gettempdir(), name)
+
+    if run_dir is None:
+        return None
+
+    if hasattr(socket, 'AF_UNIX'):
+        return os.path.join(run_dir, name + '.sock')
+
+    return os.path.join(run_dir, name + '.port')
+
+
+def _owned_by_user(sock, address):
+    """
+    Check the worker at the other end of a Unix socket is this user's own
+    """
+
+    if os.stat(address).st_uid != os.getuid():
+        return False
+
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        return uid == os.getuid()
+
+    return True
+
+
+def connect(address, timeout=CONNECT_TIMEOUT):
+    """
+    Connect to the worker at the given address, returning the socket and
+    the access token to send, or (None, None) if there's no worker (or it
+    isn't this user's)
+    """
+
+    if address is None:
+        return None, None
+
+    try:
+        if hasattr(socket, 'AF_UNIX'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+
+            try:
+                sock.connect(address)
+
+                if not _owned_by_user(sock, address):
+                    sock.close()
+                    return None, None
+            except OSError:
+                sock.close()
+                raise
+
+            return sock, ''
+
+        with open(address) as f:
+            port, token = f.read().split()
+
+        sock = socket.create_connection(('127.0.0.1', int(port)), timeout)
+        return sock, token
+
+    except (OSError, ValueError):
+        return None, None
+
+
+def send_message(sock, payload):
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+
+def recv_message(sock):
+
+    def recv_exactly(n):
+        chunks = []
+        while n:
+            chunk = sock.recv(min(n, 1 << 20))
+            if not chunk:
+                raise ConnectionError("Connection closed by the worker")
+            chunks.append(chunk)
+            n -= len(chunk)
+        return b''.join(chunks)
+
+    length, = _LENGTH.unpack(recv_exactly(_LENGTH.size))
+    return recv_exactly(length)
+
+
+def run_remote(args):
+    """
+    Run the extension with the given arguments on the worker, writing its
+    output to stdout and its messages to stderr.
+
+    Returns the exit status, or None if no worker could take the job or it
+    didn't finish it within JOB_TIMEOUT
+    """
+
+    sock, token = connect(worker_address())
+
+    if sock is None:
+        return None
+
+    job = {
+            'token': token,
+            'args': args,
+            'cwd': os.getcwd(),
+            'env': {k: os.environ.get(k) for k in JOB_ENV},
+    }
+
+    try:
+        with sock:
+            # a stuck worker mustn't hang Inkscape: after this, the job is
+            # run here instead
+            sock.settimeout(JOB_TIMEOUT)
+            send_message(sock, json.dumps(job).encode('utf-8'))
+
+            reply = json.loads(recv_message(sock).decode('utf-8'))
+            output = recv_message(sock)
+
+    except (OSError, ValueError):
+        return None
+
+    if reply.get('status') is None:
+        # the worker turned the job down
+        return None
+
+    sys.stderr.write(reply.get('stderr', ''))
+    sys.stdout.buffer.write(output)
+    sys.stdout.flush()
+
+    return reply['status']
+
+
+def start_worker():
+    """
+    Start a worker in the background, detached from this process
+    """
+
+    kwargs = {}
+
+    if os.name == 'nt':
+        kwargs['creationflags'] = (subprocess.DETACHED_PROCESS |
+                                   subprocess.CREATE_NEW_PROCESS_GROUP)
+    else:
+        kwargs['start_new_session'] = True
+
+    try:
+        subprocess.Popen([sys.executable, WORKER_SCRIPT],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, close_fds=True, **kwargs)
+    except OSError:
+        # not being able to start the worker just means no speedup
+        pass
+
+
+def run_local(args):
+    """
+    Run the extension in this process
+    """
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import label_guides
+
+    label_guides.LabelGuides().run(args)
+    return 0
+
+
+def main(argv=None):
+
+    args = list(sys.argv[1:] if argv is None else argv)
+
+    # this option is for the client only. Without it, a running worker is
+    # used, but one isn't started
+    warm_worker = None
+
+    for arg in list(args):
+        if arg.startswith('--warm_worker='):
+            warm_worker = arg.split('=', 1)[1].lower() == 'true'
+            args.remove(arg)
+
+    if warm_worker is not False:
+        status = run_remote(args)
+
+        if status is not None:
+            return status
+
+    if warm_worker:
+        start_worker()
+
+    return run_local(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
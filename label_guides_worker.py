@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+'''
+Label Guides warm worker
+
+A long-lived process that keeps the interpreter, inkex, lxml and the preset
+catalog loaded, and runs Label Guides jobs sent by label_guides_client.py
+over a local socket, one at a time. It exits after a period with no jobs.
+
+The extension modules are reloaded if they (or a preset catalog) change on
+disk, so edits and catalog updates are picked up without restarting.
+
+Licenced under the GNU General Public License v2.0
+'''
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import secrets
+import signal
+import socket
+import sys
+
+import label_geometry
+import label_guides
+from label_guides_client import (worker_address, send_message, recv_message,
+                                 connect, JOB_TIMEOUT)
+
+# Default time to wait for a job before exiting, in seconds
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+
+
+def listen(address):
+    """
+    Start listening at the given address, returning the socket and the
+    token clients must send, or (None, None) if a worker is already
+    listening there
+    """
+
+    sock, _ = connect(address)
+
+    if sock is not None:
+        sock.close()
+        return None, None
+
+    if hasattr(socket, 'AF_UNIX'):
+        # a stale socket from a worker that didn't shut down cleanly
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(address)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        # only this user may connect
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(address)
+        finally:
+            os.umask(old_umask)
+
+        server.listen()
+        return server, ''
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+
+    token = secrets.token_hex(16)
+
+    fd = os.open(address, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write("{} {}\n".format(server.getsockname()[1], token))
+
+    return server, token
+
+
+class Worker(object):
+    """
+    Runs jobs in this process, keeping the extension module loaded
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.stamp = self._stamp()
+
+    def _stamp(self):
+        """
+        Get something that changes if the extension or its catalogs change
+        """
+
+        files = [label_geometry.__file__, label_guides.__file__] + \
+            label_geometry.PRESETS._catalog_files()
+
+        mtimes = [os.path.getmtime(f) if os.path.exists(f) else None
+                  for f in files]
+
+        return mtimes + [os.environ.get(label_geometry.PRESET_PATH_ENV)]
+
+    def _refresh(self):
+
+        stamp = self._stamp()
+
+        if stamp != self.stamp:
+            # the extension module picks up the reloaded geometry
+            importlib.reload(label_geometry)
+            importlib.reload(label_guides)
+            self.stamp = self._stamp()
+
+    def run_job(self, job):
+        """
+        Run a job, returning (reply, output bytes)
+        """
+
+        if job.get('token', '') != self.token:
+            return {'status': None}, b''
+
+        env = job.get('env', {})
+
+        for key, value in env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+        self._refresh()
+
+        output = io.BytesIO()
+        messages = io.StringIO()
+        status = 0
+
+        os.chdir(job.get('cwd') or os.getcwd())
+
+        with contextlib.redirect_stderr(messages):
+            try:
+                label_guides.LabelGuides().run(job['args'], output=output)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                messages.write("{}: {}\n".format(type(e).__name__, e))
+                status = 1
+
+        return ({'status': status, 'stderr': messages.getvalue()},
+                output.getvalue())
+
+    def serve(self, server, idle_timeout):
+        """
+        Take jobs until none arrive for idle_timeout seconds
+        """
+
+        server.settimeout(idle_timeout)
+
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                return
+
+            # the accepted socket doesn't inherit the timeout, and a client
+            # that never sends its job mustn't hold up every later one
+            conn.settimeout(JOB_TIMEOUT)
+
+            with conn:
+                try:
+                    job = json.loads(recv_message(conn).decode('utf-8'))
+                    reply, output = self.run_job(job)
+
+                    send_message(conn, json.dumps(reply).encode('utf-8'))
+                    send_message(conn, output)
+                except (OSError, ValueError):
+                    # the client went away, or sent nonsense
+                    continue
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+            description='Keep Label Guides loaded, and run jobs from '
+                        'label_guides_client.py')
+    parser.add_argument('--idle-timeout', type=float,
+                        default=DEFAULT_IDLE_TIMEOUT,
+                        help='exit after this many seconds with no jobs')
+    parser.add_argument('--address', default=worker_address(),
+                        help='socket (or port file) to listen at')
+
+    args = parser.parse_args(argv)
+
+    if args.address is None:
+        sys.stderr.write("No private directory for the worker's socket; "
+                         "give one with --address\n")
+        return 1
+
+    server, token = listen(args.address)
+
+    if server is None:
+        sys.stderr.write("A worker is already running at {}\n".format(
+            args.address))
+        return 1
+
+    # load the catalog now, rather than on the first job
+    len(label_guides.PRESETS)
+
+    # clean up the socket when asked to stop, too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        with server:
+            Worker(token).serve(server, args.idle_timeout)
+    finally:
+        with contextlib.suppress(OSError):
+            os.unlink(args.address)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
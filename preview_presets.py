@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""
+Preview generator for the Label Guides preset catalog.
+
+Draws a small preview of the sheet of every preset in the catalog
+(including any extra catalogs listed in LABEL_GUIDES_PRESETS), straight
+from the template geometry, without Inkscape or inkex, and writes a contact
+sheet (index.html) to browse them:
+
+    ./preview_presets.py -o previews/
+    ./preview_presets.py -o previews/ --png --width 240
+
+Previews are SVG, and optionally also PNG (drawn here, so there's nothing
+extra to install). The previews are drawn in a process pool, and a manifest
+in the output directory records what each preview was drawn from, so later
+runs only redraw the presets that changed (and drop the ones that are gone
+from the catalog).
+
+Licenced under the GNU General Public License v2.0
+"""
+
+import argparse
+import hashlib
+import html
+import json
+import logging
+import math
+import multiprocessing
+import os
+import struct
+import sys
+import zlib
+
+import label_geometry
+
+# Bump this when the drawing changes, to redraw every preview
+PREVIEW_VERSION = 1
+
+# Records what each preview was drawn from, in the output directory
+MANIFEST_FILE = 'previews.json'
+
+CONTACT_SHEET = 'index.html'
+
+# Corner radius for rounded rectangle previews, in the template unit (the
+# extension's default)
+DEFAULT_CORNER_RAD = 1
+
+# Colours, as (R, G, B)
+PAGE_COLOUR = (255, 255, 255)
+EDGE_COLOUR = (64, 96, 160)
+LABEL_COLOUR = (214, 226, 245)
+
+# Contact sheet sections, by preset shape
+SHAPE_TITLES = [
+        ('rrect', 'Rounded rectangles'),
+        ('rect', 'Rectangles'),
+        ('circle', 'Round and oval'),
+]
+
+
+def _hex(colour):
+    return '#{:02x}{:02x}{:02x}'.format(*colour)
+
+
+def sheet_geometry(preset_id):
+    """
+    Work out what a preset's sheet looks like, in its template unit.
+
+    Returns a dict of the page size, label size, corner radius, shape and
+    cell top-left corners
+    """
+
+    preset = label_geometry.PRESETS[preset_id]
+
+    corner_rad = DEFAULT_CORNER_RAD if preset.shapes == 'rrect' else None
+    opts = label_geometry.preset_opts(preset_id, corner_rad=corner_rad)
+    grid = label_geometry.LabelGrid(opts)
+
+    sx, sy = grid.size_x, grid.size_y
+    cells = grid.cells()
+
+    page = opts['page_size']
+
+    if page is None:
+        # an unknown page: show the labels with the same margins all round
+        page = [max(x for x, _ in cells) + sx + opts['margin']['l'],
+                max(y for _, y in cells) + sy + opts['margin']['t']]
+
+    return {
+            'page': [float(page[0]), float(page[1])],
+            'size': [sx, sy],
+            'corner_rad': min(opts['corner_rad'] or 0, sx / 2, sy / 2),
+            'round': preset.shapes == 'circle',
+            'cells': cells,
+    }
+
+
+def preset_summary(preset_id):
+    """
+    Get a one-line description of a preset, for the contact sheet
+    """
+
+    preset = label_geometry.PRESETS[preset_id]
+
+    if preset.layout == 'reg':
+        count = "{} x {} = {}".format(preset.count_x, preset.count_y,
+                                      preset.count_x * preset.count_y)
+    else:
+        count = "{} ({})".format(
+                len(label_geometry.LabelGrid(
+                    label_geometry.preset_opts(preset_id)).x),
+                preset.layout)
+
+    return "{:g} x {:g}{}, {} per sheet, {}".format(
+            preset.size_x, preset.size_y, preset.units, count,
+            preset.page_size)
+
+
+def preset_digest(preset_id, formats, width):
+    """
+    Get a digest of everything a preset's previews are drawn from
+    """
+
+    record = label_geometry.PRESETS[preset_id]
+
+    key = json.dumps([PREVIEW_VERSION, preset_id, list(record), formats,
+                      width])
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def draw_svg(geom, width):
+    """
+    Draw a sheet as SVG, width pixels wide, with the viewBox in the
+    template unit
+    """
+
+    pw, ph = geom['page']
+    sx, sy = geom['size']
+    rnd = geom['corner_rad']
+
+    height = max(1, round(width * ph / pw))
+
+    # an outline about a pixel wide, whatever the scale
+    stroke = pw / width
+
+    parts = [
+            '<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" '
+            'viewBox="0 0 {:g} {:g}">'.format(width, height, pw, ph),
+            '<rect width="{:g}" height="{:g}" fill="{}"/>'.format(
+                pw, ph, _hex(PAGE_COLOUR)),
+            '<g fill="{}" stroke="{}" stroke-width="{:.4g}">'.format(
+                _hex(LABEL_COLOUR), _hex(EDGE_COLOUR), stroke),
+    ]
+
+    if geom['round']:
+        parts.extend(
+                '<ellipse cx="{:.4f}" cy="{:.4f}" rx="{:g}" ry="{:g}"/>'
+                .format(x + sx / 2, y + sy / 2, sx / 2, sy / 2)
+                for x, y in geom['cells'])
+    else:
+        corner = ' rx="{:g}"'.format(rnd) if rnd else ''
+        parts.extend(
+                '<rect x="{:.4f}" y="{:.4f}" width="{:g}" height="{:g}"{}/>'
+                .format(x, y, sx, sy, corner)
+                for x, y in geom['cells'])
+
+    parts.append('</g></svg>\n')
+
+    return '\n'.join(parts)
+
+
+def _span(geom, dy, half_x, half_y, rnd):
+    """
+    Get the half-width of a label shape at a distance dy from its centre
+    line, or None if the shape doesn't reach that far
+    """
+
+    if dy > half_y or half_x <= 0 or half_y <= 0:
+        return None
+
+    if geom['round']:
+        return half_x * math.sqrt(max(0.0, 1 - (dy / half_y) ** 2))
+
+    # in the rounded corners, the span is cut back by the corner arc
+    corner_dy = dy - (half_y - rnd)
+
+    if rnd and corner_dy > 0:
+        return half_x - rnd + math.sqrt(max(0.0, rnd ** 2 - corner_dy ** 2))
+
+    return half_x
+
+
+def draw_png(geom, width):
+    """
+    Draw a sheet as PNG, width pixels wide, sampling each pixel at its
+    centre. Each label is filled with the outline colour and then again,
+    a pixel smaller all round, with the label colour.
+    """
+
+    pw, ph = geom['page']
+    sx, sy = geom['size']
+
+    scale = width / pw
+    height = max(1, round(ph * scale))
+
+    # one pixel, in the template unit
+    px = 1 / scale
+
+    rows = [bytearray(bytes(PAGE_COLOUR) * width) for _ in range(height)]
+
+    layers = [(EDGE_COLOUR, 0), (LABEL_COLOUR, px)]
+
+    for x, y in geom['cells']:
+
+        cx, cy = x + sx / 2, y + sy / 2
+
+        for colour, inset in layers:
+
+            half_x = sx / 2 - inset
+            half_y = sy / 2 - inset
+            rnd = max(0.0, geom['corner_rad'] - inset)
+
+            top = max(0, math.ceil((cy - half_y) * scale - 0.5))
+            bottom = min(height, math.floor((cy + half_y) * scale + 0.5))
+
+            for row in range(top, bottom):
+
+                half = _span(geom, abs((row + 0.5) / scale - cy),
+                             half_x, half_y, rnd)
+
+                if half is None:
+                    continue
+
+                left = max(0, math.ceil((cx - half) * scale - 0.5))
+                right = min(width, math.floor((cx + half) * scale + 0.5))
+
+                if right > left:
+                    rows[row][left * 3:right * 3] = \
+                        bytes(colour) * (right - left)
+
+    return png_bytes(width, height, rows)
+
+
+def png_bytes(width, height, rows):
+    """
+    Encode rows of 8-bit RGB pixels as a PNG file
+    """
+
+    def chunk(tag, data):
+        return (struct.pack('!I', len(data)) + tag + data +
+                struct.pack('!I', zlib.crc32(tag + data) & 0xffffffff))
+
+    # each row starts with its filter type (0: none)
+    raw = b''.join(b'\x00' + bytes(row) for row in rows)
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('!IIBBBBB', width, height,
+                                       8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw, 9)) +
+            chunk(b'IEND', b''))
+
+
+def preview_job(job):
+    """
+    Draw the previews of one preset, in a worker process.
+
+    Returns (preset ID, list of files written, error string or None)
+    """
+
+    preset_id, out_dir, formats, width = job
+
+    files = []
+
+    try:
+        geom = sheet_geometry(preset_id)
+
+        for fmt in formats:
+
+            name = preset_id + '.' + fmt
+
+            if fmt == 'svg':
+                data = draw_svg(geom, width).encode('utf-8')
+            else:
+                data = draw_png(geom, width)
+
+            with open(os.path.join(out_dir, name), 'wb') as f:
+                f.write(data)
+
+            files.append(name)
+
+    except Exception as e:
+        return (preset_id, files, "{}: {}".format(type(e).__name__, e))
+
+    return (preset_id, files, None)
+
+
+def load_manifest(out_dir):
+    """
+    Get the record of the previews already in a directory, by preset ID
+    """
+
+    try:
+        with open(os.path.join(out_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if manifest.get('version') != PREVIEW_VERSION:
+        return {}
+
+    return manifest.get('presets', {})
+
+
+def save_manifest(out_dir, entries):
+
+    with open(os.path.join(out_dir, MANIFEST_FILE), 'w') as f:
+        json.dump({'version': PREVIEW_VERSION, 'presets': entries}, f,
+                  indent=1, sort_keys=True)
+
+
+def write_contact_sheet(out_dir, entries, width):
+    """
+    Write an HTML page of every preview, by shape, with a filter box
+    """
+
+    sections = []
+    titles = dict(SHAPE_TITLES)
+
+    shapes = [s for s, _ in SHAPE_TITLES] + sorted(
+            {e['shape'] for e in entries.values()} - set(titles))
+
+    for shape in shapes:
+
+        ids = sorted(i for i, e in entries.items() if e['shape'] == shape)
+
+        if not ids:
+            continue
+
+        figures = []
+
+        for preset_id in ids:
+            entry = entries[preset_id]
+            image = entry['files'][-1]
+
+            figures.append(
+                    '<figure data-search="{search}">'
+                    '<a href="{link}"><img src="{image}" width="{width}" '
+                    'loading="lazy" alt="{id}"></a>'
+                    '<figcaption><b>{id}</b><br>{summary}</figcaption>'
+                    '</figure>'.format(
+                        search=html.escape(
+                            (preset_id + ' ' + entry['summary']).lower()),
+                        link=html.escape(entry['files'][0]),
+                        image=html.escape(image),
+                        width=width,
+                        id=html.escape(preset_id),
+                        summary=html.escape(entry['summary'])))
+
+        sections.append('<h2>{}</h2>\n<div class="sheet">\n{}\n</div>'.format(
+                html.escape(titles.get(shape, shape)), '\n'.join(figures)))
+
+    page = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Label Guides presets</title>
+<style>
+body {{ font-family: sans-serif; margin: 1em 2em; }}
+.sheet {{ display: flex; flex-wrap: wrap; gap: 1em; }}
+figure {{ margin: 0; width: {width}px; font-size: small; }}
+img {{ border: 1px solid #ccc; }}
+</style>
+</head>
+<body>
+<h1>Label Guides presets</h1>
+<p>{count} presets. Filter: <input id="filter" type="search"
+ placeholder="ID, size or count"></p>
+{sections}
+<script>
+document.getElementById('filter').addEventListener('input', function () {{
+    var text = this.value.toLowerCase();
+    document.querySelectorAll('figure').forEach(function (f) {{
+        f.hidden = f.dataset.search.indexOf(text) < 0;
+    }});
+}});
+</script>
+</body>
+</html>
+""".format(width=width, count=len(entries), sections='\n'.join(sections))
+
+    with open(os.path.join(out_dir, CONTACT_SHEET), 'w',
+              encoding='utf-8') as f:
+        f.write(page)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+            description='Draw previews of every Label Guides preset, and a '
+                        'contact sheet to browse them')
+    parser.add_argument('-o', '--output-dir', required=True,
+                        help='directory to write the previews to')
+    parser.add_argument('--width', type=int, default=160,
+                        help='preview width, in pixels')
+    parser.add_argument('--png', action='store_true',
+                        help='draw PNG previews as well as SVG')
+    parser.add_argument('--force', action='store_true',
+                        help='redraw every preview, even if unchanged')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='verbose mode')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(message)s")
+
+    if args.width < 1:
+        parser.error("--width must be at least 1")
+
+    formats = ['svg', 'png'] if args.png else ['svg']
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    old = {} if args.force else load_manifest(args.output_dir)
+    entries = {}
+    jobs = []
+    drawn = failed = 0
+
+    for preset_id in label_geometry.PRESETS:
+
+        try:
+            digest = preset_digest(preset_id, formats, args.width)
+            entry = {
+                    'digest': digest,
+                    'shape': label_geometry.PRESETS[preset_id].shapes,
+                    'summary': preset_summary(preset_id),
+                    'files': [preset_id + '.' + fmt for fmt in formats],
+            }
+        except (KeyError, ValueError) as e:
+            failed += 1
+            logging.error("Can't preview %s: %s", preset_id, e)
+            continue
+
+        entries[preset_id] = entry
+
+        prev = old.get(preset_id)
+
+        if prev and prev['digest'] == digest and all(
+                os.path.exists(os.path.join(args.output_dir, f))
+                for f in entry['files']):
+            continue
+
+        jobs.append((preset_id, args.output_dir, formats, args.width))
+
+    with multiprocessing.Pool(args.jobs) as pool:
+
+        # previews are quick to draw, so hand them out in batches
+        workers = args.jobs or os.cpu_count() or 1
+        chunksize = max(1, len(jobs) // (4 * workers))
+
+        for preset_id, files, err in pool.imap_unordered(preview_job, jobs,
+                                                         chunksize):
+            if err:
+                failed += 1
+                del entries[preset_id]
+                logging.error("Failed to preview %s: %s", preset_id, err)
+            else:
+                drawn += 1
+                logging.debug("Drew %s", ', '.join(files))
+
+    # previews of presets that are gone from the catalog (or were drawn in
+    # formats no longer asked for)
+    keep = {f for e in entries.values() for f in e['files']}
+
+    for entry in old.values():
+        for name in entry['files']:
+            if name not in keep:
+                try:
+                    os.remove(os.path.join(args.output_dir, name))
+                except OSError:
+                    pass
+
+    save_manifest(args.output_dir, entries)
+    write_contact_sheet(args.output_dir, entries, args.width)
+
+    logging.info("Drew %d previews, %d unchanged, %d failed",
+                 drawn, len(entries) - drawn, failed)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Shared fixtures: a local HTTP server standing in for the label template
+site, serving the recorded pages in fixtures/
+"""
+
+import email.utils
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# the scripts live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fixtures')
+
+LIST_ROW = ('<tr><td>21</td><td>63.5mm x 38.1mm</td>'
+            '<td>LP21/{n} Avery L71{n:02d} '
+            '<a href="{base}p/{n}.html">x</a></td></tr>')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+class FixtureServer(object):
+    """
+    Serves a list page of `products` round labels and a product page for
+    each, with ETag and Last-Modified validators.
+
+    Tests can slow pages down (delays, by path), make them fail (fail, a
+    set of paths), change them (versions, by path), drop their ETags
+    (no_etag), leave the validators out of their 304s (bare_304) or answer
+    every request for them with a 304 (not_modified). Every request is logged as (path, request headers, status),
+    and the most requests in flight at once is kept.
+    """
+
+    def __init__(self, products=6):
+
+        self.products = products
+        self.delays = {}
+        self.fail = set()
+        self.versions = {}
+        self.no_etag = set()
+        self.bare_304 = set()
+        self.not_modified = set()
+
+        self.log = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+        self.list_page = read_fixture('list.html')
+        self.product_page = read_fixture('product.html')
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base = 'http://127.0.0.1:{}/'.format(self.httpd.server_port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    def product_url(self, n):
+        return '{}p/{}.html'.format(self.base, n)
+
+    def requests_for(self, path):
+        return [entry for entry in self.log if entry[0] == path]
+
+    def _respond(self, request):
+        """
+        Get (status, headers, body) for a request
+        """
+
+        path = request.path
+
+        if path in self.fail:
+            return 500, {}, b'broken'
+
+        if path == '/label-templates/round.php':
+            rows = "\n".join(LIST_ROW.format(n=n, base=self.base)
+                             for n in range(self.products))
+            return 200, {}, self.list_page.format(rows=rows).encode('utf-8')
+
+        if not re.match(r'^/p/\d+\.html$', path):
+            return 404, {}, b'not found'
+
+        version = self.versions.get(path, 1)
+
+        headers = {'Last-Modified': email.utils.formatdate(
+                1600000000 + version * 3600, usegmt=True)}
+
+        if path not in self.no_etag:
+            headers['ETag'] = '"{}-v{}"'.format(path, version)
+
+        if_none_match = request.headers.get('If-None-Match')
+
+        if if_none_match is not None:
+            not_modified = if_none_match == headers.get('ETag')
+        else:
+            not_modified = request.headers.get('If-Modified-Since') == \
+                headers['Last-Modified']
+
+        if not_modified or path in self.not_modified:
+            return 304, {} if path in self.bare_304 else headers, b''
+
+        body = self.product_page.format(count_y=6 + version)
+        return 200, headers, body.encode('utf-8')
+
+    def _handle(self, request):
+
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            time.sleep(self.delays.get(request.path, 0))
+
+            status, headers, body = self._respond(request)
+
+            # logged before replying, so the client never sees a reply to
+            # a request that isn't in the log yet
+            with self.lock:
+                self.log.append((request.path, dict(request.headers),
+                                 status))
+
+            request.send_response(status)
+            for name, value in headers.items():
+                request.send_header(name, value)
+            request.send_header('Content-Length', str(len(body)))
+            request.end_headers()
+            request.wfile.write(body)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    with FixtureServer() as s:
+        yield s
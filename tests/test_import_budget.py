@@ -0,0 +1,27 @@
+"""
+Tests that label_geometry stays quick to import, for the thin client and
+command line tools that use it without inkex
+"""
+
+import benchmark
+
+
+def test_label_geometry_imports_within_budget():
+
+    assert benchmark.check_import(benchmark.DEFAULT_IMPORT_BUDGET,
+                                  repeat=3) == []
+
+
+def test_label_geometry_does_not_import_heavy_modules():
+
+    _, heavy = benchmark.measure_import('label_geometry', repeat=1)
+
+    assert heavy == []
+
+
+def test_over_budget_import_is_reported():
+
+    problems = benchmark.check_import(0, repeat=1)
+
+    assert len(problems) == 1
+    assert problems[0].startswith("import/label_geometry: ")
@@ -0,0 +1,160 @@
+"""
+Tests for the concurrent scraper in down_spec.py, against the local fixture
+server
+"""
+
+import concurrent.futures
+import time
+
+import pytest
+
+import down_spec
+from conftest import read_fixture
+
+SPEC = {
+        'size_x': '63.5', 'size_y': '38.1', 'count_x': '3', 'count_y': '7',
+        'margin_t': '15.15', 'margin_l': '7.25', 'pitch_x': '66',
+        'pitch_y': '38.1',
+}
+
+
+@pytest.fixture
+def site(server, monkeypatch):
+    monkeypatch.setattr(down_spec.FormatFinder, 'base_url',
+                        server.base + 'label-templates/')
+    return server
+
+
+def scrape(fetcher, concurrency=4):
+    """
+    Scrape the round labels, returning the (LP code, error, time, layout)
+    of each item as it was reported, and the number of failures
+    """
+
+    reported = []
+
+    def on_item(item, error):
+        reported.append((item['lpcode'], error, time.monotonic(),
+                         item.get('layout')))
+
+    failures = down_spec.scrape_all(['circ'], fetcher, concurrency, on_item)
+
+    return reported, failures
+
+
+def test_fetches_run_concurrently(server):
+
+    for n in range(server.products):
+        server.delays['/p/{}.html'.format(n)] = 0.2
+
+    fetcher = down_spec.Fetcher(concurrency=3)
+    urls = [server.product_url(n) for n in range(server.products)]
+
+    start = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(3) as pool:
+        pages = list(pool.map(fetcher.get, urls))
+
+    elapsed = time.monotonic() - start
+
+    assert len(pages) == server.products
+    assert server.max_in_flight == 3
+    # six 0.2s pages, three at a time
+    assert elapsed < 0.2 * server.products * 0.75
+
+
+def test_fetches_keep_to_the_rate_limit(server):
+
+    rate = 20
+    fetcher = down_spec.Fetcher(concurrency=4, rate=rate)
+    urls = [server.product_url(n) for n in range(server.products)]
+
+    start = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        list(pool.map(fetcher.get, urls))
+
+    elapsed = time.monotonic() - start
+
+    # the first request goes straight away, the rest are spaced out
+    assert elapsed >= (len(urls) - 1) / rate * 0.9
+
+
+def test_items_stream_out_as_they_finish(site):
+
+    site.delays['/p/0.html'] = 0.5
+
+    reported, failures = scrape(down_spec.Fetcher(concurrency=4))
+
+    assert failures == 0
+    assert sorted(code for code, _, _, _ in reported) == \
+        sorted('LP21/{}'.format(n) for n in range(site.products))
+
+    # the slow page comes out last, and the others didn't wait for it
+    assert reported[-1][0] == 'LP21/0'
+    assert reported[-2][2] < reported[-1][2] - 0.3
+
+    # the items come back with their layouts
+    assert all(error is None and layout['count_y'] == '7'
+               for _, error, _, layout in reported)
+
+
+def test_failing_page_does_not_stop_the_others(site):
+
+    site.fail.add('/p/3.html')
+
+    reported, failures = scrape(down_spec.Fetcher(concurrency=4))
+
+    assert failures == 1
+
+    errors = {code: error for code, error, _, _ in reported}
+
+    assert len(errors) == site.products
+    assert errors.pop('LP21/3') is not None
+    assert all(error is None for error in errors.values())
+
+
+def test_failing_list_is_counted(site):
+
+    site.fail.add('/label-templates/round.php')
+
+    reported, failures = scrape(down_spec.Fetcher())
+
+    assert failures == 1
+    assert reported == []
+
+
+def parse_table(edit):
+    """
+    Parse the recorded product page, with its spec table edited
+    """
+
+    page = read_fixture('product.html').format(count_y=7)
+    head, table = page.split('class="templatetable">')
+
+    return down_spec.SpecRipper(None)._parse_page(
+            head + 'class="templatetable">' + edit(table))['layout']
+
+
+def test_spec_table_ignores_comments_between_rows():
+
+    def add_comments(table):
+        return table.replace('</tr><tr>', '</tr><!-- x --><tr>')
+
+    assert parse_table(add_comments) == SPEC
+
+
+def test_spec_table_with_a_missing_row_tag():
+
+    def drop_third_tr(table):
+        rows = table.split('<tr>')
+        return '<tr>'.join(rows[:3]) + rows[3] + \
+            ''.join('<tr>' + r for r in rows[4:])
+
+    assert parse_table(drop_third_tr) == SPEC
+
+    def both(table):
+        return drop_third_tr(table).replace('</tr><tr>',
+                                            '</tr><!-- x --><tr>')
+
+    assert parse_table(both) == SPEC
@@ -0,0 +1,198 @@
+"""
+Tests for the scraper's page cache in down_spec.py: conditional
+revalidation, resuming an interrupted run and offline parsing, against the
+local fixture server
+"""
+
+import io
+import json
+import os
+
+import pytest
+import requests
+
+import down_spec
+from conftest import read_fixture
+
+
+class CountingParser(object):
+    """
+    Parses product pages, counting how many it was given
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, text):
+        self.calls += 1
+        return down_spec.SpecRipper(None)._parse_page(text)
+
+
+def fetch(server, cache, n=0):
+
+    parse = CountingParser()
+    data = down_spec.Fetcher(cache=cache).get_parsed(server.product_url(n),
+                                                     parse)
+
+    return data, parse.calls
+
+
+def test_etag_revalidation_gets_not_modified(server, tmp_path):
+
+    cache = down_spec.SpecCache(str(tmp_path / 'cache.jsonl'))
+
+    first, parsed = fetch(server, cache)
+    assert parsed == 1
+
+    # a new run revalidates everything
+    cache.finish()
+
+    second, parsed = fetch(server, cache)
+
+    path, headers, status = server.requests_for('/p/0.html')[-1]
+
+    assert headers['If-None-Match'] == '"/p/0.html-v1"'
+    assert status == 304
+    assert parsed == 0
+    assert second == first
+
+
+def test_last_modified_revalidation_gets_not_modified(server, tmp_path):
+
+    server.no_etag.add('/p/0.html')
+    cache = down_spec.SpecCache(str(tmp_path / 'cache.jsonl'))
+
+    first, _ = fetch(server, cache)
+    cache.finish()
+    second, parsed = fetch(server, cache)
+
+    path, headers, status = server.requests_for('/p/0.html')[-1]
+
+    assert 'If-None-Match' not in headers
+    assert headers['If-Modified-Since']
+    assert status == 304
+    assert parsed == 0
+    assert second == first
+
+
+def test_validators_kept_when_not_modified_omits_them(server, tmp_path):
+
+    server.bare_304.add('/p/0.html')
+    cache = down_spec.SpecCache(str(tmp_path / 'cache.jsonl'))
+
+    fetch(server, cache)
+
+    for _ in range(2):
+        cache.finish()
+        fetch(server, cache)
+
+        path, headers, status = server.requests_for('/p/0.html')[-1]
+
+        assert status == 304
+        assert headers['If-None-Match'] == '"/p/0.html-v1"'
+
+    assert cache.get(server.product_url(0))['etag'] == '"/p/0.html-v1"'
+    assert cache.get(server.product_url(0))['last_modified']
+
+
+def test_not_modified_with_nothing_cached_is_an_error(server, tmp_path):
+
+    server.not_modified.add('/p/0.html')
+    cache = down_spec.SpecCache(str(tmp_path / 'cache.jsonl'))
+
+    with pytest.raises(requests.HTTPError):
+        fetch(server, cache)
+
+    assert cache.get(server.product_url(0)) is None
+
+
+def test_changed_page_is_parsed_again(server, tmp_path):
+
+    cache = down_spec.SpecCache(str(tmp_path / 'cache.jsonl'))
+
+    first, _ = fetch(server, cache)
+    cache.finish()
+
+    server.versions['/p/0.html'] = 2
+    second, parsed = fetch(server, cache)
+
+    assert server.requests_for('/p/0.html')[-1][2] == 200
+    assert parsed == 1
+    assert first['layout']['count_y'] == '7'
+    assert second['layout']['count_y'] == '8'
+
+    # and the new validators are kept
+    assert cache.get(server.product_url(0))['etag'] == '"/p/0.html-v2"'
+
+
+def test_interrupted_run_resumes_from_checkpoint(server, tmp_path):
+
+    path = str(tmp_path / 'cache.jsonl')
+    cache = down_spec.SpecCache(path)
+
+    for n in range(3):
+        fetch(server, cache, n)
+
+    # lines that are JSON, but not cache entries
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('[]\n1\n{"etag": null, "data": {}, "done": true}\n')
+
+    # the run stops before finish(), part-way through writing a line
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"url": "http://127.0.0.1/p/9.html", "da')
+
+    requests_before = len(server.log)
+
+    resumed = down_spec.SpecCache(path)
+
+    assert len(resumed.done) == 3
+
+    for n in range(3):
+        data, parsed = fetch(server, resumed, n)
+        assert parsed == 0
+        assert data['layout']['count_y'] == '7'
+
+    # nothing that was done was asked for again
+    assert len(server.log) == requests_before
+
+    # but pages that weren't done still are
+    fetch(server, resumed, 3)
+    assert len(server.log) == requests_before + 1
+
+    # finishing compacts the journal and clears the checkpoint
+    resumed.finish()
+
+    with open(path, encoding='utf-8') as f:
+        lines = [json.loads(line) for line in f]
+
+    assert len(lines) == 4
+    assert not any(line.get('done') for line in lines)
+    assert not down_spec.SpecCache(path).done
+
+
+def test_offline_parsing_of_saved_pages(tmp_path):
+
+    page = read_fixture('product.html')
+
+    for n in range(4):
+        (tmp_path / '{}.html'.format(n)).write_text(
+                page.format(count_y=n + 1), encoding='utf-8')
+
+    (tmp_path / 'broken.html').write_text('<html></html>', encoding='utf-8')
+    (tmp_path / 'notes.txt').write_text('not a page', encoding='utf-8')
+
+    out = io.StringIO()
+    failures = down_spec.parse_offline(str(tmp_path), 2, out)
+
+    records = {os.path.basename(r['file']): r
+               for r in map(json.loads, out.getvalue().splitlines())}
+
+    assert failures == 1
+    assert sorted(records) == ['0.html', '1.html', '2.html', '3.html',
+                               'broken.html']
+    assert 'error' in records['broken.html']
+
+    for n in range(4):
+        record = records['{}.html'.format(n)]
+        assert record['layout']['count_y'] == str(n + 1)
+        assert record['desc'] == 'Address Labels'
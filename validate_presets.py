@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Validator for the Label Guides preset catalog.
+
+Checks every preset in the catalog (including any extra catalogs listed in
+LABEL_GUIDES_PRESETS):
+
+    * the record parses, and uses a known layout, unit, page size and shape
+    * sizes and pitches are positive and there is at least one label
+    * labels don't overlap (pitch smaller than the label size)
+    * the whole grid fits on the page
+    * gutters between labels are either zero (butted) or at least
+      --min-gutter wide
+    * every preset has an item in label_guides.inx, on the notebook tab for
+      its shape, and every INX item refers to a preset
+
+Regular grids are checked from the preset fields, for the whole catalog at
+once, and other layouts (staggered, hex-packed, lists) label by label.
+
+A JSON report of the issues found can be written with --json:
+
+    ./validate_presets.py --json report.json
+
+Licenced under the GNU General Public License v2.0
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+
+import numpy
+from lxml import etree
+
+import label_geometry
+from label_geometry import SHAPE_TABS, UNIT_MM
+
+INX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'label_guides.inx')
+
+# Named page sizes are in mm, so only make sense with mm templates
+NAMED_PAGE_UNIT = 'mm'
+
+# Numeric preset fields, in catalog order
+NUMERIC_FIELDS = ['margin_l', 'margin_t', 'size_x', 'size_y',
+                  'pitch_x', 'pitch_y', 'count_x', 'count_y']
+
+# Slack allowed in comparisons, in mm, for rounding in the catalog
+TOLERANCE = 0.01
+
+
+class Report(object):
+    """
+    Collects the issues found, by preset
+    """
+
+    def __init__(self):
+        self.issues = []
+
+    def add(self, preset_id, check, severity, message):
+        self.issues.append({
+                'id': preset_id,
+                'check': check,
+                'severity': severity,
+                'message': message
+        })
+
+    def count(self, severity):
+        return sum(1 for i in self.issues if i['severity'] == severity)
+
+    def as_dict(self, checked):
+        return {
+                'presets': checked,
+                'errors': self.count('error'),
+                'warnings': self.count('warning'),
+                'issues': self.issues
+        }
+
+
+def load_presets(presets, report):
+    """
+    Parse every preset, reporting any that can't be parsed.
+
+    Returns a dict of preset ID to Preset
+    """
+
+    records = {}
+
+    for preset_id in presets:
+        try:
+            records[preset_id] = presets[preset_id]
+        except ValueError as e:
+            report.add(preset_id, 'record', 'error', str(e))
+
+    return records
+
+
+def layout_grid(preset, scale):
+    """
+    Compile the layout of a preset into a LabelGrid, in mm
+    """
+
+    opts = {
+            'margin': {'l': preset.margin_l * scale,
+                       't': preset.margin_t * scale},
+            'size': {'x': preset.size_x * scale, 'y': preset.size_y * scale},
+            'pitch': {'x': preset.pitch_x * scale,
+                      'y': preset.pitch_y * scale},
+            'count': {'x': preset.count_x, 'y': preset.count_y},
+            'layout': label_geometry.layout_params(
+                preset.layout, preset.params, preset.pitch_x * scale,
+                preset.count_x, lambda v: v * scale),
+    }
+
+    return label_geometry.LabelGrid(opts)
+
+
+def check_cells(preset_id, grid, round_shapes, page, min_gutter, report):
+    """
+    Check the cells of any layout, one by one: for layouts that aren't
+    regular grids, so can't be checked from the preset fields alone.
+
+    Neighbours are found with a sweep along X, so each label is only
+    compared with those in nearby columns.
+    """
+
+    sx, sy = grid.size_x, grid.size_y
+    x = numpy.asarray(grid.x)
+    y = numpy.asarray(grid.y)
+
+    if not len(x):
+        report.add(preset_id, 'count', 'error', "No labels")
+        return
+
+    if sx <= 0 or sy <= 0:
+        report.add(preset_id, 'size', 'error',
+                   "Label size is not positive: {:g} x {:g}mm".format(sx, sy))
+        return
+
+    if x.min() < -TOLERANCE or y.min() < -TOLERANCE or \
+            x.max() + sx > page[0] + TOLERANCE or \
+            y.max() + sy > page[1] + TOLERANCE:
+        report.add(preset_id, 'page', 'error',
+                   "Labels run off the page: {:.4g} x {:.4g}mm > "
+                   "{:.4g} x {:.4g}mm".format(x.max() + sx, y.max() + sy,
+                                              page[0], page[1]))
+
+    order = numpy.argsort(x, kind='stable')
+    x, y = x[order], y[order]
+
+    overlaps = 0
+    narrowest = None
+
+    for i in range(len(x)):
+        j = i + 1
+
+        while j < len(x) and x[j] - x[i] < sx + min_gutter:
+
+            dx = abs(x[j] - x[i])
+            dy = abs(y[j] - y[i])
+
+            if round_shapes:
+                # equal ellipses touch at unit distance, once scaled
+                gap = math.hypot(dx / sx, dy / sy) - 1
+                gap *= min(sx, sy)
+            else:
+                gap = max(dx - sx, dy - sy)
+
+            if gap < -TOLERANCE:
+                overlaps += 1
+            elif gap > TOLERANCE and (narrowest is None or gap < narrowest):
+                narrowest = gap
+
+            j += 1
+
+    if overlaps:
+        report.add(preset_id, 'overlap', 'error',
+                   "{} pair(s) of labels overlap".format(overlaps))
+
+    if narrowest is not None and narrowest < min_gutter - TOLERANCE:
+        report.add(preset_id, 'gutter', 'warning',
+                   "Gutter is only {:.3g}mm".format(narrowest))
+
+
+def check_geometry(records, min_gutter, report):
+    """
+    Check the physical layout of every preset: regular grids all at once,
+    from the preset fields, and other layouts cell by cell
+    """
+
+    ids = list(records)
+
+    if not ids:
+        return
+
+    recs = [records[i] for i in ids]
+
+    # Everything in mm, one row per preset
+    scale = numpy.array([UNIT_MM.get(r.units, numpy.nan) for r in recs])
+    f = {name: numpy.array([getattr(r, name) for r in recs], dtype=float)
+         for name in NUMERIC_FIELDS}
+
+    page = numpy.full((len(recs), 2), numpy.nan)
+    reg = numpy.array([r.layout == 'reg' for r in recs])
+
+    for n, r in enumerate(recs):
+
+        if r.layout not in label_geometry.LAYOUTS:
+            report.add(ids[n], 'layout', 'error',
+                       "Unknown layout: {}".format(r.layout))
+
+        if r.units not in UNIT_MM:
+            report.add(ids[n], 'units', 'error',
+                       "Unknown units: {}".format(r.units))
+
+        if r.shapes not in SHAPE_TABS:
+            report.add(ids[n], 'shape', 'error',
+                       "Shape is never drawn: {}".format(r.shapes))
+
+        size = label_geometry.parse_page_size(r.page_size)
+
+        if size is None:
+            report.add(ids[n], 'page', 'error',
+                       "Unknown page size: {}".format(r.page_size))
+            continue
+
+        if r.page_size in label_geometry.PAGE_SIZES and \
+                r.units != NAMED_PAGE_UNIT:
+            report.add(ids[n], 'page', 'error',
+                       "Named page size {} used with {} units".format(
+                           r.page_size, r.units))
+
+        page[n] = size
+
+    for n, r in enumerate(recs):
+
+        if reg[n] or r.layout not in label_geometry.LAYOUTS or \
+                numpy.isnan(scale[n]) or numpy.isnan(page[n][0]):
+            continue
+
+        try:
+            grid = layout_grid(r, scale[n])
+        except ValueError as e:
+            report.add(ids[n], 'layout', 'error', str(e))
+            continue
+
+        check_cells(ids[n], grid, r.shapes == 'circle', page[n] * scale[n],
+                    min_gutter, report)
+
+    mm = {name: f[name] * scale for name in NUMERIC_FIELDS[:6]}
+    page = page * scale[:, None]
+
+    def flag(mask, check, severity, message, *columns):
+        for n in numpy.flatnonzero(mask & reg):
+            report.add(ids[n], check, severity, message.format(
+                    *[c[n] for c in columns]))
+
+    for axis, margin in [('x', 'l'), ('y', 't')]:
+
+        size = mm['size_' + axis]
+        pitch = mm['pitch_' + axis]
+        count = f['count_' + axis]
+        margin = mm['margin_' + margin]
+        page_len = page[:, 0 if axis == 'x' else 1]
+
+        flag(count < 1, 'count', 'error',
+             "No labels in " + axis + ": {:g}", count)
+        flag(size <= 0, 'size', 'error',
+             "Label size in " + axis + " is not positive: {:g}mm", size)
+
+        multi = count > 1
+        gutter = pitch - size
+
+        flag(multi & (pitch <= 0), 'pitch', 'error',
+             "Pitch in " + axis + " is not positive: {:g}mm", pitch)
+        flag(multi & (gutter < -TOLERANCE), 'overlap', 'error',
+             "Labels overlap in " + axis + ": pitch {:g}mm < size {:g}mm",
+             pitch, size)
+        flag(multi & (gutter > TOLERANCE) & (gutter < min_gutter - TOLERANCE),
+             'gutter', 'warning',
+             "Gutter in " + axis + " is only {:.3g}mm", gutter)
+
+        far = margin + (count - 1) * pitch + size
+
+        flag(margin < -TOLERANCE, 'page', 'error',
+             "Labels start off the page in " + axis + ": margin {:g}mm",
+             margin)
+        flag(far > page_len + TOLERANCE, 'page', 'error',
+             "Labels run off the page in " + axis + ": {:.4g}mm > {:.4g}mm",
+             far, page_len)
+
+
+def read_inx_items(inx_file):
+    """
+    Get the preset items from the INX file, as a list of (tab, preset ID)
+    """
+
+    root = etree.parse(inx_file).getroot()
+    items = []
+
+    for param in root.iter('{*}param'):
+
+        name = param.get('name', '')
+
+        if not name.endswith('_preset'):
+            continue
+
+        tab = name[:-len('_preset')]
+        items.extend((tab, item.get('value')) for item in param.iter('{*}item'))
+
+    return items
+
+
+def check_inx(records, inx_items, report):
+    """
+    Check that the INX and the catalog agree with each other
+    """
+
+    seen = {}
+
+    for tab, preset_id in inx_items:
+
+        if preset_id in seen:
+            report.add(preset_id, 'inx', 'warning',
+                       "Listed more than once in the INX")
+
+        seen[preset_id] = tab
+
+        if preset_id not in records:
+            report.add(preset_id, 'inx', 'error',
+                       "INX item on the {} tab has no preset".format(tab))
+            continue
+
+        want = SHAPE_TABS.get(records[preset_id].shapes)
+
+        if want is not None and tab != want:
+            report.add(preset_id, 'inx', 'error',
+                       "Listed on the {} tab, but is a {} preset".format(
+                           tab, want))
+
+    for preset_id in records:
+        if preset_id not in seen:
+            report.add(preset_id, 'inx', 'warning',
+                       "Not selectable: no INX item")
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+            description='Check the Label Guides preset catalog')
+    parser.add_argument('--inx', default=INX_FILE,
+                        help='INX file to check the presets against')
+    parser.add_argument('--no-inx', action='store_true',
+                        help="don't check against the INX file (e.g. for "
+                             "catalogs that aren't bundled)")
+    parser.add_argument('--min-gutter', type=float, default=1.0,
+                        help='narrowest gap between labels (mm) that '
+                             "doesn't get a warning, 0 to allow any")
+    parser.add_argument('--json',
+                        help='write the report to this file ("-" for stdout)')
+    parser.add_argument('--strict', action='store_true',
+                        help='fail on warnings as well as errors')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='verbose mode')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(message)s")
+
+    report = Report()
+
+    records = load_presets(label_geometry.PRESETS, report)
+    check_geometry(records, args.min_gutter, report)
+
+    if not args.no_inx:
+        check_inx(records, read_inx_items(args.inx), report)
+
+    for issue in report.issues:
+        log = logging.error if issue['severity'] == 'error' \
+            else logging.warning
+        log("%s: %s [%s]", issue['id'], issue['message'], issue['check'])
+
+    result = report.as_dict(len(label_geometry.PRESETS))
+
+    if args.json == '-':
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    logging.info("Checked %d presets: %d errors, %d warnings",
+                 result['presets'], result['errors'], result['warnings'])
+
+    if result['errors'] or (args.strict and result['warnings']):
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())